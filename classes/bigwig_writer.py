@@ -0,0 +1,236 @@
+import zlib
+import struct
+import numpy as np
+
+
+class BigWigWriter(object):
+    MAGIC = 0x888FFC26
+    VERSION = 4
+    CHROM_TREE_MAGIC = 0x78CA8C91
+    RTREE_MAGIC = 0x2468ACE0
+    BEDGRAPH_SECTION = 1
+    ITEMS_PER_SLOT = 1024  # intervals (or zoom records) per compressed block
+    BLOCK_SIZE = 256  # children per R-tree node
+    MAX_ZOOM_LEVELS = 10
+    ZOOM_INCREMENT = 4
+
+    HEADER_SIZE = 64
+    ZOOM_HEADER_SIZE = 24
+    SUMMARY_SIZE = 40
+
+    def __init__(self, file_path, chr_sizes):
+        """
+        Writer of bigWig files (indexed binary tracks): bedGraph sections compressed with zlib, an R-tree index of
+        the sections, a B+ tree of chromosomes and zoom levels (summaries of increasing window sizes, each one with
+        its own R-tree) so genome browsers can fetch small ranges without downloading the whole file.
+        Intervals are kept in memory and the file is written on 'close'.
+        :param file_path:
+        :param chr_sizes: dict of chromosome name (e.g. 'chr1') to size
+        """
+        self.file_path = file_path
+        self.chr_sizes = chr_sizes
+        self.chroms = sorted(chr_sizes)  # chromosome ids follow the order of the names (B+ tree keys)
+        self.intervals = {}  # chrom to list of (starts, ends, values) arrays
+        self.uncompress_buf_size = 0
+
+    def add_intervals(self, chrom, starts, ends, values):
+        """
+        Add intervals of a chromosome, intervals must be sorted and must not overlap
+        :param chrom: chromosome name
+        :param starts: array of starts (0 based)
+        :param ends: array of ends (exclusive)
+        :param values: array of values
+        """
+        if chrom not in self.chr_sizes:
+            raise ValueError('Unknown chromosome: %s' % chrom)
+        self.intervals.setdefault(chrom, []).append((np.asarray(starts, dtype=np.uint32),
+                                                     np.asarray(ends, dtype=np.uint32),
+                                                     np.asarray(values, dtype=np.float32)))
+
+    def __get_chrom_intervals(self):
+        # list of (chrom id, starts, ends, values) sorted by chromosome id
+        chrom_intervals = []
+        for chrom_id, chrom in enumerate(self.chroms):
+            if chrom not in self.intervals:
+                continue
+            starts, ends, values = [np.concatenate(arrays) for arrays in zip(*self.intervals[chrom])]
+            order = np.argsort(starts, kind='mergesort')
+            chrom_intervals.append((chrom_id, starts[order], ends[order], values[order]))
+        return chrom_intervals
+
+    def __get_reductions(self, chrom_intervals):
+        # zoom levels: window sizes starting at 4 times the smallest interval, increased 4 times on each level
+        spans = [int(np.min(ends - starts)) for chrom_id, starts, ends, values in chrom_intervals if len(starts)]
+        if not spans:
+            return []
+        max_size = max(self.chr_sizes.values())
+        reductions = []
+        reduction = max(1, min(spans)) * self.ZOOM_INCREMENT
+        while len(reductions) < self.MAX_ZOOM_LEVELS and reduction < max_size:
+            reductions.append(reduction)
+            reduction *= self.ZOOM_INCREMENT
+        return reductions
+
+    @staticmethod
+    def __zoom_records(chrom_id, starts, ends, values, reduction):
+        # summaries of the zoom windows with data, each interval is summarized in the window where it starts
+        bins = starts // reduction
+        first = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+        bases = (ends - starts).astype(np.float64)
+        weighted = values.astype(np.float64) * bases
+
+        records = np.zeros(len(first), dtype=[('chrom_id', '<u4'), ('start', '<u4'), ('end', '<u4'),
+                                               ('valid_count', '<u4'), ('min', '<f4'), ('max', '<f4'),
+                                               ('sum', '<f4'), ('sum_squares', '<f4')])
+        records['chrom_id'] = chrom_id
+        records['start'] = starts[first]
+        records['end'] = np.maximum.reduceat(ends, first)
+        records['valid_count'] = np.add.reduceat(bases, first)
+        records['min'] = np.minimum.reduceat(values, first)
+        records['max'] = np.maximum.reduceat(values, first)
+        records['sum'] = np.add.reduceat(weighted, first)
+        records['sum_squares'] = np.add.reduceat(weighted * values, first)
+        return records
+
+    def __write_block(self, f, data):
+        # writes a compressed block, returns its size
+        self.uncompress_buf_size = max(self.uncompress_buf_size, len(data))
+        block = zlib.compress(data)
+        f.write(block)
+        return len(block)
+
+    def __write_chrom_tree(self, f):
+        key_size = max(len(chrom) for chrom in self.chroms)
+        block_size = len(self.chroms)
+        f.write(struct.pack('<IIIIQQ', self.CHROM_TREE_MAGIC, block_size, key_size, 8, len(self.chroms), 0))
+        # a single leaf node with all the chromosomes
+        f.write(struct.pack('<BBH', 1, 0, len(self.chroms)))
+        for chrom_id, chrom in enumerate(self.chroms):
+            f.write(chrom.ljust(key_size, '\0') + struct.pack('<II', chrom_id, self.chr_sizes[chrom]))
+
+    def __write_rtree(self, f, items, end_file_offset):
+        """
+        Writes an R-tree index of blocks
+        :param items: list of tuples (chrom id, start, chrom id, end, file offset, size) sorted by position
+        """
+        # build the levels from the leaves: a node is a tuple (bounds, children)
+        levels = [[(self.__bounds(items[i:i + self.BLOCK_SIZE]), items[i:i + self.BLOCK_SIZE])
+                   for i in range(0, len(items), self.BLOCK_SIZE)]]
+        while len(levels[-1]) > 1:
+            nodes = levels[-1]
+            levels.append([(self.__bounds([node[0] for node in nodes[i:i + self.BLOCK_SIZE]]),
+                            nodes[i:i + self.BLOCK_SIZE]) for i in range(0, len(nodes), self.BLOCK_SIZE)])
+        levels.reverse()
+
+        bounds = levels[0][0][0] if items else (0, 0, 0, 0)
+        f.write(struct.pack('<IIQIIIIQII', self.RTREE_MAGIC, self.BLOCK_SIZE, len(items), bounds[0], bounds[1],
+                            bounds[2], bounds[3], end_file_offset, 1, 0))
+        if not items:
+            f.write(struct.pack('<BBH', 1, 0, 0))
+            return
+
+        # nodes are written level by level from the root, compute the offset of each node
+        offset = f.tell()
+        offsets = []
+        for depth, nodes in enumerate(levels):
+            item_size = 32 if depth == len(levels) - 1 else 24
+            level_offsets = []
+            for node in nodes:
+                level_offsets.append(offset)
+                offset += 4 + item_size * len(node[1])
+            offsets.append(level_offsets)
+
+        for depth, nodes in enumerate(levels):
+            is_leaf = depth == len(levels) - 1
+            child = 0
+            for node in nodes:
+                f.write(struct.pack('<BBH', 1 if is_leaf else 0, 0, len(node[1])))
+                for item in node[1]:
+                    if is_leaf:
+                        f.write(struct.pack('<IIIIQQ', *item))
+                    else:
+                        f.write(struct.pack('<IIIIQ', item[0][0], item[0][1], item[0][2], item[0][3],
+                                            offsets[depth + 1][child]))
+                        child += 1
+
+    @staticmethod
+    def __bounds(items):
+        # bounds (start chrom, start, end chrom, end) of items or bounds sorted by position
+        end = max(items, key=lambda item: (item[2], item[3]))
+        return items[0][0], items[0][1], end[2], end[3]
+
+    def close(self):
+        chrom_intervals = self.__get_chrom_intervals()
+        reductions = self.__get_reductions(chrom_intervals)
+        f = open(self.file_path, 'wb')
+
+        # header, zoom headers and total summary are written at the end
+        f.write('\0' * (self.HEADER_SIZE + self.ZOOM_HEADER_SIZE * len(reductions) + self.SUMMARY_SIZE))
+
+        chrom_tree_offset = f.tell()
+        self.__write_chrom_tree(f)
+
+        # data sections
+        data_offset = f.tell()
+        num_sections = sum((len(starts) + self.ITEMS_PER_SLOT - 1) / self.ITEMS_PER_SLOT
+                           for chrom_id, starts, ends, values in chrom_intervals)
+        f.write(struct.pack('<Q', num_sections))
+        index_items = []
+        item_dtype = np.dtype([('start', '<u4'), ('end', '<u4'), ('value', '<f4')])
+        for chrom_id, starts, ends, values in chrom_intervals:
+            for i in range(0, len(starts), self.ITEMS_PER_SLOT):
+                items = np.zeros(len(starts[i:i + self.ITEMS_PER_SLOT]), dtype=item_dtype)
+                items['start'] = starts[i:i + self.ITEMS_PER_SLOT]
+                items['end'] = ends[i:i + self.ITEMS_PER_SLOT]
+                items['value'] = values[i:i + self.ITEMS_PER_SLOT]
+                start, end = int(items['start'][0]), int(items['end'][-1])
+                header = struct.pack('<IIIIIBBH', chrom_id, start, end, 0, 0, self.BEDGRAPH_SECTION, 0, len(items))
+                offset = f.tell()
+                size = self.__write_block(f, header + items.tobytes())
+                index_items.append((chrom_id, start, chrom_id, end, offset, size))
+
+        index_offset = f.tell()
+        self.__write_rtree(f, index_items, index_offset)
+
+        # zoom levels
+        zoom_headers = []
+        for reduction in reductions:
+            records = np.concatenate([self.__zoom_records(chrom_id, starts, ends, values, reduction)
+                                      for chrom_id, starts, ends, values in chrom_intervals])
+            zoom_data_offset = f.tell()
+            f.write(struct.pack('<I', len(records)))
+            zoom_items = []
+            for i in range(0, len(records), self.ITEMS_PER_SLOT):
+                block = records[i:i + self.ITEMS_PER_SLOT]
+                offset = f.tell()
+                size = self.__write_block(f, block.tobytes())
+                # a block may span several chromosomes
+                zoom_items.append((int(block['chrom_id'][0]), int(block['start'][0]), int(block['chrom_id'][-1]),
+                                   int(block['end'][-1]), offset, size))
+            zoom_index_offset = f.tell()
+            self.__write_rtree(f, zoom_items, zoom_index_offset)
+            zoom_headers.append(struct.pack('<IIQQ', reduction, 0, zoom_data_offset, zoom_index_offset))
+
+        f.write(struct.pack('<I', self.MAGIC))
+
+        # total summary
+        bases_covered = 0
+        min_value, max_value, sum_data, sum_squares = np.inf, -np.inf, 0.0, 0.0
+        for chrom_id, starts, ends, values in chrom_intervals:
+            bases = (ends - starts).astype(np.float64)
+            bases_covered += int(bases.sum())
+            min_value = min(min_value, float(values.min()))
+            max_value = max(max_value, float(values.max()))
+            sum_data += float((values * bases).sum())
+            sum_squares += float((values.astype(np.float64) ** 2 * bases).sum())
+        if bases_covered == 0:
+            min_value, max_value = 0.0, 0.0
+
+        f.seek(0)
+        f.write(struct.pack('<IHHQQQHHQQIQ', self.MAGIC, self.VERSION, len(reductions), chrom_tree_offset,
+                            data_offset, index_offset, 0, 0, 0, self.HEADER_SIZE + self.ZOOM_HEADER_SIZE *
+                            len(reductions), self.uncompress_buf_size, 0))
+        for zoom_header in zoom_headers:
+            f.write(zoom_header)
+        f.write(struct.pack('<Qdddd', bases_covered, min_value, max_value, sum_data, sum_squares))
+        f.close()
@@ -0,0 +1,141 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+
+class DbSnpIndex(object):
+    VERSION = 1
+    valid_chrs = [str(i) for i in range(1, 23)] + ['X', 'Y']
+    CHR_BITS = 5  # bits of the chr code in the keys
+
+    def __init__(self, index_dir):
+        """
+        Persistent rs id to (chr, position) index built from a dbSNP dump. Keys (numeric rs id and chr code) are kept
+        sorted in a binary file that is memory mapped and searched with binary search, so a lookup costs time
+        proportional to the query and not to dbSNP.
+        :param index_dir: directory created by 'build'
+        """
+        self.index_dir = index_dir
+        f = open(os.path.join(index_dir, 'meta.json'), 'r')
+        self.meta = json.load(f)
+        f.close()
+        self.keys = np.load(os.path.join(index_dir, 'keys.npy'), mmap_mode='r')
+        self.positions = np.load(os.path.join(index_dir, 'positions.npy'), mmap_mode='r')
+
+    @staticmethod
+    def source_stamp(source_file):
+        stat = os.stat(source_file)
+        return {'name': os.path.basename(source_file), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+    @classmethod
+    def is_valid(cls, index_dir, source_file=None):
+        """
+        :return: True if the index exists, has the current version and was built from source_file (if given)
+        """
+        meta_file = os.path.join(index_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return False
+        f = open(meta_file, 'r')
+        meta = json.load(f)
+        f.close()
+        if meta['version'] != cls.VERSION:
+            return False
+        return source_file is None or meta['source'] == cls.source_stamp(source_file)
+
+    @classmethod
+    def __make_keys(cls, rs_numbers, chr_codes):
+        return (np.asarray(rs_numbers, dtype=np.int64) << cls.CHR_BITS) | np.asarray(chr_codes, dtype=np.int64)
+
+    @staticmethod
+    def __rs_number(rs_id):
+        # numeric part of a rs id or None
+        if rs_id.startswith('rs') and rs_id[2:].isdigit():
+            return int(rs_id[2:])
+        return None
+
+    @classmethod
+    def build(cls, index_dir, snps, source_file=None):
+        """
+        Build an index from the snps of a dbSNP dump, if a snp appears more than once in a chromosome the last
+        position is kept. Ids that are not rs ids are skipped.
+        :param index_dir: output directory (replaced if it exists)
+        :param snps: iterable of tuples (chr, rs_id, position)
+        :param source_file: dbSNP dump the snps come from, used to detect outdated indexes
+        :return: the DbSnpIndex
+        """
+        chr_codes = {chro: code for code, chro in enumerate(cls.valid_chrs)}
+        keys = []
+        positions = []
+        block_keys = ([], [])
+        block_positions = []
+
+        for chro, rs_id, pos in snps:
+            rs_number = cls.__rs_number(rs_id)
+            if rs_number is None or chro not in chr_codes:
+                continue
+            block_keys[0].append(rs_number)
+            block_keys[1].append(chr_codes[chro])
+            block_positions.append(pos)
+            if len(block_positions) == 1 << 20:
+                # keep memory low converting the snps read to arrays
+                keys.append(cls.__make_keys(*block_keys))
+                positions.append(np.array(block_positions, dtype=np.int32))
+                block_keys = ([], [])
+                block_positions = []
+
+        keys.append(cls.__make_keys(*block_keys))
+        positions.append(np.array(block_positions, dtype=np.int32))
+        keys = np.concatenate(keys)
+        positions = np.concatenate(positions)
+
+        # stable sort and keep the last occurrence of every key
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        positions = positions[order]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        keys = keys[last]
+        positions = positions[last]
+
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(index_dir)))
+        np.save(os.path.join(tmp_dir, 'keys.npy'), keys)
+        np.save(os.path.join(tmp_dir, 'positions.npy'), positions)
+        f = open(os.path.join(tmp_dir, 'meta.json'), 'w')
+        json.dump({'version': cls.VERSION, 'num_snps': len(keys),
+                   'source': cls.source_stamp(source_file) if source_file is not None else None}, f)
+        f.close()
+
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(tmp_dir, index_dir)
+        return cls(index_dir)
+
+    def lookup(self, chro, rs_ids):
+        """
+        Positions of a list of snps of a chromosome
+        :param chro: chromosome (without 'chr' prefix)
+        :param rs_ids: list of rs ids
+        :return: a tuple (array of indexes in rs_ids of the snps found, array of their positions)
+        """
+        if chro not in self.valid_chrs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+
+        query = []
+        rs_numbers = []
+        for i, rs_id in enumerate(rs_ids):
+            rs_number = self.__rs_number(rs_id)
+            if rs_number is not None:
+                query.append(i)
+                rs_numbers.append(rs_number)
+
+        query = np.array(query, dtype=np.int64)
+        keys = self.__make_keys(rs_numbers, np.repeat(self.valid_chrs.index(chro), len(rs_numbers)))
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        found = np.asarray(self.keys[idx] == keys) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        return query[found], np.asarray(self.positions[idx[found]])
+
+    def get_num_snps(self):
+        return len(self.keys)
@@ -1,24 +1,67 @@
-import gzip
 import os
+import collections
+import numpy as np
+from classes.input_reader import InputReader
 
 
 class EnrichR(object):
+    LIBRARY_CACHE_SIZE = 4  # resolved libraries kept in memory
+    __library_cache = collections.OrderedDict()  # (library stamp, mart hash, record filter) to resolved library
+
     @staticmethod
     def load_library(file_name):
         data = {}
-        f = gzip.open(file_name, 'r') if file_name.endswith('.gz') else open(file_name, 'r')
-
-        for line in f:
-            toks = line.split('\t')
-            record = toks[0]
-            genes = []
-            for gene_res in toks[2:]:
-                gene_res = gene_res.strip().split(',')
-                # build for each gene a tuple (gene, weight)
-                genes.append((gene_res[0], 1.0 if len(gene_res) == 1 else float(gene_res[1])))
-            data[record] = genes
-
-        f.close()
+        with InputReader(file_name) as f:
+            for line in f:
+                toks = line.split('\t')
+                record = toks[0]
+                genes = []
+                for gene_res in toks[2:]:
+                    gene_res = gene_res.strip().split(',')
+                    # build for each gene a tuple (gene, weight)
+                    genes.append((gene_res[0], 1.0 if len(gene_res) == 1 else float(gene_res[1])))
+                data[record] = genes
+        return data
+
+    @classmethod
+    def load_resolved_library(cls, file_name, genes_db, record_filter=None):
+        """
+        Streaming load of a library with the gene names resolved to gene indices of genes_db (names not found are
+        dropped, weights are ignored). Records rejected by record_filter are skipped before parsing their genes.
+        The last libraries loaded are cached per (library file, mart file of genes_db, record_filter), libraries
+        resolved with a database that was not loaded from a mart file or a snapshot are not cached.
+        :param file_name: full path to enrich_db table
+        :param genes_db: GeneDatabase
+        :param record_filter: lambda function for record filtering
+        :return: dict of record to int32 array of gene indices
+        """
+        stat = os.stat(file_name)
+        key = (os.path.abspath(file_name), stat.st_size, int(stat.st_mtime), genes_db.source_stamp, record_filter)
+        cache = genes_db.source_stamp is not None
+        if cache and key in cls.__library_cache:
+            data = cls.__library_cache.pop(key)
+            cls.__library_cache[key] = data  # most recently used
+            return data
+
+        data = {}
+        with InputReader(file_name) as f:
+            for line in f:
+                toks = line.split('\t', 1)
+                record = toks[0]
+                if record_filter is not None and not record_filter(record):
+                    continue
+                gene_idxs = []
+                for gene_res in (toks[1].split('\t')[1:] if len(toks) > 1 else []):
+                    idx = genes_db.get_index_by_name(gene_res.strip().split(',')[0])
+                    if idx is not None:
+                        gene_idxs.append(idx)
+                data[record] = np.array(gene_idxs, dtype=np.int32)
+
+        if not cache:
+            return data
+        cls.__library_cache[key] = data
+        while len(cls.__library_cache) > cls.LIBRARY_CACHE_SIZE:
+            cls.__library_cache.popitem(last=False)
         return data
 
     @staticmethod
@@ -0,0 +1,150 @@
+import os
+import sys
+import json
+import time
+import hashlib
+
+
+class VariationBatchJob(object):
+    def __init__(self, client, species='human', checkpoint_file=None, max_attempts=4, backoff=2.0):
+        """
+        Resolves a list of rs ids through the Ensembl variation POST endpoint. Keeps track of the ids requested,
+        found, missing (not found by Ensembl) and failed (request error), retries failed batches with exponential
+        backoff and records each completed batch in a checkpoint file (json lines) to resume after interruption. The
+        first line of the checkpoint identifies the requested ids, a checkpoint of other ids is ignored.
+        :param client: an EnsemblRestClient
+        :param species:
+        :param checkpoint_file: path of the checkpoint file or None
+        :param max_attempts: max number of attempts of a batch
+        :param backoff: seconds to wait before the first retry, doubled on each attempt
+        """
+        self.client = client
+        self.species = species
+        self.checkpoint_file = checkpoint_file
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.requested = []
+        self.found = {}
+        self.missing = set([])
+        self.failed = set([])
+        self.num_requests = 0
+        self.elapsed = 0
+
+    def __requested_hash(self):
+        # identifies the set of requested ids
+        return hashlib.sha1('\n'.join(sorted(self.requested))).hexdigest()
+
+    def __load_checkpoint(self):
+        """
+        Loads the batches of a checkpoint of the requested ids
+        :return: True if loaded, False if there is no checkpoint or it belongs to other ids
+        """
+        if self.checkpoint_file is None or not os.path.isfile(self.checkpoint_file):
+            return False
+        f = open(self.checkpoint_file, 'r')
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('requested') != self.__requested_hash():
+            f.close()
+            sys.stderr.write('Ignoring checkpoint {0}: it belongs to other ids\n'.format(self.checkpoint_file))
+            return False
+
+        requested = set(self.requested)
+        for line in f:
+            try:
+                batch = json.loads(line)
+            except ValueError:
+                break  # incomplete line written during an interruption
+            self.found.update((rs_id, data) for rs_id, data in batch['found'].items() if rs_id in requested)
+            self.missing.update(rs_id for rs_id in batch['missing'] if rs_id in requested)
+        f.close()
+        return True
+
+    def __open_checkpoint(self, resume):
+        # appends to the loaded checkpoint or starts a new one
+        if resume:
+            return open(self.checkpoint_file, 'a')
+        f = open(self.checkpoint_file, 'w')
+        f.write(json.dumps({'requested': self.__requested_hash()}) + '\n')
+        f.flush()
+        return f
+
+    def __write_checkpoint(self, f, found, missing):
+        if f is not None:
+            f.write(json.dumps({'found': found, 'missing': missing}) + '\n')
+            f.flush()
+
+    def run(self, ids):
+        """
+        :param ids: list of rs ids
+        :return: dict of rs_id: data for the ids found
+        """
+        start_time = time.time()
+        cache = self.client.cache
+        max_post = self.client.max_post
+
+        # remove duplicated ids (keep order)
+        seen = set([])
+        self.requested = [rs_id for rs_id in ids if not (rs_id in seen or seen.add(rs_id))]
+
+        resume = self.__load_checkpoint()
+        pending = [rs_id for rs_id in self.requested if rs_id not in self.found and rs_id not in self.missing]
+
+        if cache is not None:
+            # only request ids not found in cache
+            cached, pending = cache.get_variations(self.species, self.client.assembly, pending,
+                                                   include_expired=self.client.offline)
+            self.found.update(cached)
+            self.missing.update(set(self.requested).difference(self.found).difference(pending))
+
+        if self.client.offline:
+            self.failed = set(pending)
+            pending = []
+
+        checkpoint = self.__open_checkpoint(resume) if self.checkpoint_file is not None and pending else None
+        attempt = 0
+
+        while pending and attempt < self.max_attempts:
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            batches = [pending[i:i + max_post] for i in range(0, len(pending), max_post)]
+            results = self.client.transport.map(lambda batch_ids: self.client.perform_rest_action(
+                '/variation/' + self.species, hdrs={"Accept": "application/json"}, post_data={'ids': batch_ids}),
+                batches)
+            self.num_requests += len(batches)
+            pending = []
+
+            for batch_ids, result in zip(batches, results):
+                if result is None:
+                    pending += batch_ids  # failed request, retry later
+                    continue
+                missing = [rs_id for rs_id in batch_ids if rs_id not in result]
+                self.found.update(result)
+                self.missing.update(missing)
+                self.__write_checkpoint(checkpoint, result, missing)
+                if cache is not None:
+                    cache.put_variations(self.species, self.client.assembly, batch_ids, result)
+            attempt += 1
+
+        self.failed.update(pending)
+
+        if checkpoint is not None:
+            checkpoint.close()
+
+        if self.checkpoint_file is not None and not self.failed and os.path.isfile(self.checkpoint_file):
+            os.remove(self.checkpoint_file)  # job finished
+
+        if cache is not None and not self.client.offline:
+            cache.evict()  # offline runs keep the expired entries, they are the only source of data
+
+        self.elapsed = time.time() - start_time
+        return {rs_id: self.found[rs_id] for rs_id in self.requested if rs_id in self.found}
+
+    def print_stats(self):
+        print 'Ensembl variations: %i requested, %i found, %i missing, %i failed' % (
+            len(self.requested), len(set(self.requested).intersection(self.found)), len(self.missing), len(self.failed))
+        print '%i requests in %.1fs (%.1f ids/s)' % (self.num_requests, self.elapsed,
+                                                     len(self.requested) / max(self.elapsed, 1e-6))
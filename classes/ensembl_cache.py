@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import time
+
+
+class EnsemblCache(object):
+    MAX_PARAMS = 500  # max number of ids per sqlite query
+
+    def __init__(self, db_path, ttl=90 * 24 * 3600, max_entries=2000000):
+        """
+        Persistent cache (sqlite) of Ensembl REST variation responses keyed by (species, rs_id, assembly).
+        Ids not found by Ensembl are cached too (with null data), so they are not requested again.
+        :param db_path: path to the sqlite database file
+        :param ttl: time to live of the entries in seconds
+        :param max_entries: max number of entries, least recently used entries are evicted when exceeded
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS variation ('
+                          'species TEXT, rs_id TEXT, assembly TEXT, data TEXT, created REAL, accessed REAL, '
+                          'PRIMARY KEY (species, rs_id, assembly))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS variation_accessed ON variation (accessed)')
+        self.conn.commit()
+
+    def get_variations(self, species, assembly, ids, include_expired=False):
+        """
+        Look up variations in the cache
+        :param species:
+        :param assembly:
+        :param ids: list of rs ids
+        :param include_expired: return also entries older than ttl (used in offline mode)
+        :return: a tuple (dict of found rs_id: data, list of ids not in cache). Ids cached as not found by
+        Ensembl are not included in any of them.
+        """
+        now = time.time()
+        min_created = 0 if include_expired else now - self.ttl
+        found = {}
+        cached = set([])
+
+        for start in range(0, len(ids), self.MAX_PARAMS):
+            chunk = ids[start:start + self.MAX_PARAMS]
+            rows = self.conn.execute(
+                'SELECT rs_id, data FROM variation WHERE species = ? AND assembly = ? AND created >= ? AND '
+                'rs_id IN (%s)' % ','.join('?' * len(chunk)), [species, assembly, min_created] + chunk)
+            for rs_id, data in rows:
+                cached.add(rs_id)
+                if data is not None:
+                    found[rs_id] = json.loads(data)
+
+        if cached:
+            self.conn.executemany('UPDATE variation SET accessed = ? WHERE species = ? AND rs_id = ? AND assembly = ?',
+                                  [(now, species, rs_id, assembly) for rs_id in cached])
+            self.conn.commit()
+
+        return found, [rs_id for rs_id in ids if rs_id not in cached]
+
+    def put_variations(self, species, assembly, ids, result):
+        """
+        Store the response of a request in the cache
+        :param species:
+        :param assembly:
+        :param ids: list of requested rs ids
+        :param result: dict of rs_id: data as returned by Ensembl
+        """
+        now = time.time()
+        rows = [(species, rs_id, assembly, json.dumps(data), now, now) for rs_id, data in result.items()]
+        rows += [(species, rs_id, assembly, None, now, now) for rs_id in ids if rs_id not in result]
+        self.conn.executemany('INSERT OR REPLACE INTO variation VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+
+    def evict(self):
+        """
+        Remove expired entries and the least recently used ones when the cache exceeds max_entries
+        """
+        self.conn.execute('DELETE FROM variation WHERE created < ?', (time.time() - self.ttl,))
+        count = self.conn.execute('SELECT COUNT(*) FROM variation').fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute('DELETE FROM variation WHERE rowid IN '
+                              '(SELECT rowid FROM variation ORDER BY accessed LIMIT ?)', (count - self.max_entries,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -1,18 +1,29 @@
 import sys
-import urllib
-import urllib2
 import json
-import time
-import requests
+from classes.http_transport import HttpTransport
+from classes.ensembl_batch import VariationBatchJob
 
 
 class EnsemblRestClient(object):
-    def __init__(self, server='http://rest.ensembl.org', reqs_per_sec=15):
+    def __init__(self, server='http://rest.ensembl.org', reqs_per_sec=15, assembly='GRCh38', cache=None,
+                 offline=False, max_workers=4):
+        """
+        :param server: REST server url
+        :param reqs_per_sec: max number of requests per second
+        :param assembly: assembly served by the server (used as key of cached responses)
+        :param cache: an EnsemblCache for variation lookups or None
+        :param offline: do not perform requests, variations are only read from cache (requires a cache)
+        :param max_workers: number of concurrent requests
+        """
+        if offline and cache is None:
+            raise ValueError('Offline mode requires a cache')
         self.server = server
         self.reqs_per_sec = reqs_per_sec
-        self.req_count = 0
-        self.last_req = 0
         self.max_post = 200
+        self.assembly = assembly
+        self.cache = cache
+        self.offline = offline
+        self.transport = HttpTransport(reqs_per_sec=reqs_per_sec, max_workers=max_workers)
 
     def perform_rest_action(self, endpoint, hdrs=None, params=None, post_data=None):
         if hdrs is None:
@@ -21,51 +32,11 @@ class EnsemblRestClient(object):
         if 'Content-Type' not in hdrs:
             hdrs['Content-Type'] = 'application/json'
 
-        if params:
-            endpoint += '?' + urllib.urlencode(params)
-
-        # check if we need to rate limit ourselves
-        if self.req_count >= self.reqs_per_sec:
-            delta = time.time() - self.last_req
-            if delta < 1:
-                time.sleep(1 - delta)
-            self.last_req = time.time()
-            self.req_count = 0
-
         if post_data is None:
-            return self.__perform_rest_get(endpoint, hdrs, params)
-
-        return self.__perform_rest_post(endpoint, hdrs, post_data)
-
-    def __perform_rest_get(self, endpoint, hdrs, params):
-        data = None
-        try:
-            request = urllib2.Request(self.server + endpoint, headers=hdrs)
-            response = urllib2.urlopen(request)
-            content = response.read()
-            if content:
-                data = json.loads(content)
-            self.req_count += 1
+            return self.transport.request('GET', self.server + endpoint, headers=hdrs, params=params)
 
-        except urllib2.HTTPError, e:
-            # check if we are being rate limited by the server
-            if e.code == 429:
-                if 'Retry-After' in e.headers:
-                    retry = e.headers['Retry-After']
-                    time.sleep(float(retry))
-                    return self.perform_rest_action(endpoint, hdrs, params)
-            else:
-                sys.stderr.write(
-                    'Request failed for {0}: Status code: {1.code} Reason: {1.reason}\n'.format(endpoint, e))
-                return None
-        return data
-
-    def __perform_rest_post(self, endpoint, hdrs, post_data):
-        r = requests.post(self.server + endpoint, headers=hdrs, data=json.dumps(post_data))
-        if not r.ok:
-            sys.stderr.write('Request failed for {0}: Status code: {1}\n'.format(endpoint, r.status_code))
-            return None
-        return r.json()
+        return self.transport.request('POST', self.server + endpoint, headers=hdrs, params=params,
+                                      data=json.dumps(post_data))
 
     def get_variants(self, species, symbol):
         genes = self.perform_rest_action(
@@ -81,17 +52,17 @@ class EnsemblRestClient(object):
             return variants
         return None
 
-    def get_snps(self, ids, species='human'):
-        ext = "/variation/" + species
-        snps = {}
-        start = 0
-
-        while start < len(ids):
-            result = self.perform_rest_action(ext, hdrs={"Accept": "application/json"},
-                                              post_data={'ids': ids[start:start + self.max_post]})
-            start += len(result)
-            snps.update(result)
-
+    def get_snps(self, ids, species='human', checkpoint_file=None):
+        """
+        Get variation data of a list of rs ids (see VariationBatchJob)
+        :param ids: list of rs ids
+        :param species:
+        :param checkpoint_file: file to record completed batches and resume an interrupted job
+        :return: dict of rs_id: data
+        """
+        job = VariationBatchJob(self, species=species, checkpoint_file=checkpoint_file)
+        snps = job.run(ids)
+        job.print_stats()
         return snps
 
 ########################################
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy.special import gammaln
+
+
+class FisherExact(object):
+    # relative tolerance used by scipy.stats.fisher_exact to compare table probabilities
+    EPSILON = 1 - 1e-4
+
+    def __init__(self, max_cells=4000000):
+        """
+        Batched two-sided Fisher exact test over many 2x2 tables [[a, b], [c, d]], equivalent to calling
+        scipy.stats.fisher_exact for each table. The hypergeometric probabilities of every table in a batch are
+        computed with NumPy arrays and a cache of log-factorials (keep an instance to reuse the cache). Odds ratios
+        are identical to scipy's, p-values are not bit-identical: they differ by up to ~3e-10 (relative) because
+        the probabilities come from log-factorials and are summed in a different order.
+        :param max_cells: maximum size of the (tables x support) probability grid computed at once
+        """
+        self.max_cells = max_cells
+        self.log_factorials = np.zeros(1)
+
+    def __get_log_factorials(self, n):
+        # log(k!) for k in [0, n], extends the cache when needed
+        if len(self.log_factorials) <= n:
+            self.log_factorials = gammaln(np.arange(n + 1) + 1.0)
+        return self.log_factorials
+
+    def test(self, a, b, c, d):
+        """
+        Runs the test for arrays of tables
+        :param a: array of table[0][0] values
+        :param b: array of table[0][1] values
+        :param c: array of table[1][0] values
+        :param d: array of table[1][1] values
+        :return: a tuple of arrays (oddsratios, pvalues)
+        """
+        a, b, c, d = [np.asarray(v, dtype=np.int64).reshape(-1) for v in (a, b, c, d)]
+        num = len(a)
+        oddsratios = np.empty(num)
+        pvalues = np.empty(num)
+
+        if num == 0:
+            return oddsratios, pvalues
+
+        if np.any(a < 0) or np.any(b < 0) or np.any(c < 0) or np.any(d < 0):
+            raise ValueError("All values in the tables must be nonnegative.")
+
+        # odds ratio as in scipy: a*d/(c*b), inf when c or b are zero
+        valid_or = (c > 0) & (b > 0)
+        oddsratios[:] = np.inf
+        oddsratios[valid_or] = (a[valid_or] * d[valid_or]) / (c[valid_or] * b[valid_or]).astype(np.float64)
+
+        # tables with a zero row or column sum: nan odds ratio and p-value 1
+        degenerate = (a + b == 0) | (c + d == 0) | (a + c == 0) | (b + d == 0)
+        oddsratios[degenerate] = np.nan
+        pvalues[degenerate] = 1.0
+
+        todo = np.flatnonzero(~degenerate)
+        if len(todo) > 0:
+            self.__get_log_factorials(int(np.max(a + b + c + d)))
+            # group tables of similar support size to keep the probability grid small
+            widths = (np.minimum(a + b, a + c) - np.maximum(0, a - d) + 1)[todo]
+            order = np.argsort(widths, kind='mergesort')
+            todo = todo[order]
+            widths = widths[order]
+            start = 0
+            while start < len(todo):
+                cells = (np.arange(start, len(todo)) - start + 1) * widths[start:]
+                end = start + max(1, np.searchsorted(cells, self.max_cells, side='right'))
+                sel = todo[start:end]
+                pvalues[sel] = self.__two_sided_pvalues(a[sel], b[sel], c[sel], d[sel])
+                start = end
+
+        return oddsratios, pvalues
+
+    def __two_sided_pvalues(self, a, b, c, d):
+        lf = self.log_factorials
+        r1 = a + b  # row sums
+        r2 = c + d
+        c1 = a + c  # first column sum
+        total = r1 + r2
+
+        # support of the hypergeometric distribution of table[0][0]
+        lo = np.maximum(0, c1 - r2)
+        hi = np.minimum(r1, c1)
+        width = int(np.max(hi - lo)) + 1
+        ks = lo[:, np.newaxis] + np.arange(width)[np.newaxis, :]
+        in_support = ks <= hi[:, np.newaxis]
+        ks_in = np.where(in_support, ks, lo[:, np.newaxis])
+
+        const = lf[r1] + lf[r2] + lf[c1] + lf[total - c1] - lf[total]
+        log_pmf = const[:, np.newaxis] - lf[ks_in] - lf[r1[:, np.newaxis] - ks_in] - lf[c1[:, np.newaxis] - ks_in] - \
+            lf[r2[:, np.newaxis] - c1[:, np.newaxis] + ks_in]
+        pmf = np.where(in_support, np.exp(log_pmf), 0.0)
+
+        rows = np.arange(len(a))
+        mode = (c1 + 1) * (r1 + 1) // (total + 2)
+        pexact = pmf[rows, a - lo]
+        pmode = pmf[rows, mode - lo]
+
+        # tables as or less likely than the observed one: the tail beyond the observed value plus the values of
+        # the opposite side of the mode with probability <= pexact (up to the relative tolerance)
+        below = (a < mode)[:, np.newaxis]
+        same_tail = np.where(below, ks <= a[:, np.newaxis], ks >= a[:, np.newaxis])
+        other_side = np.where(below, ks >= mode[:, np.newaxis], ks <= mode[:, np.newaxis])
+        other_tail = other_side & (pmf <= (pexact / self.EPSILON)[:, np.newaxis])
+        pvalues = np.sum(np.where(same_tail | other_tail, pmf, 0.0), axis=1)
+
+        # observed table as likely as the mode
+        pvalues[np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= 1 - self.EPSILON] = 1.0
+        return np.minimum(pvalues, 1.0)
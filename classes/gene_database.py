@@ -1,64 +1,252 @@
-import gzip
+import os
+import json
+import shutil
+import hashlib
+import tempfile
 import collections
+import numpy as np
+from classes.input_reader import InputReader
 
 Gene = collections.namedtuple('Gene', ['id', 'name', 'chr', 'start', 'end', 'strand', 'type'])
 
 
 class GeneDatabase(object):
     valid_chrs = [str(i) for i in range(1, 23)] + ['X', 'Y']
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_ARRAYS = ['chrs', 'starts', 'ends', 'strands', 'types']
+    SNAPSHOT_STRINGS = ['ids', 'names', 'type_names']
 
     def __init__(self, taxonomy_id):
         """
+        Gene database stored in columns: genes are identified by an integer index and their fields are kept in
+        contiguous arrays (starts, ends, strands, chromosome and type codes).
         :param taxonomy_id:
         """
         self.taxonomy_id = taxonomy_id
-        self.gene_index = {}
-        self.name_index = {}
-        self.chr_index = {}
+        self.gene_index = {}  # gene id to gene index
+        self.name_index = {}  # gene name (upper case) to gene index
+        self.chr_index = {}  # chr to array of gene indices sorted by start position
+        self.chr_starts = {}  # chr to sorted array of gene starts
+        self.chr_max_length = {}  # chr to max gene length
+        self.ids = []
+        self.names = []
+        self.type_names = []  # type code to gene type
+        self.chrs = np.zeros(0, dtype=np.int8)  # chr codes (index in valid_chrs)
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.ends = np.zeros(0, dtype=np.int64)
+        self.strands = np.zeros(0, dtype=np.int8)
+        self.types = np.zeros(0, dtype=np.int16)
+        self.source_hash = None  # hash of the loaded mart file (only computed for snapshots)
+        self.source_stamp = None  # (path, size, mtime) of the loaded mart file or hash of the loaded snapshot
 
-    def load_mart_export(self, mart_file):
+    def load_mart_export(self, mart_file, snapshot_dir=None):
         """
         Load a biomart export TSV (gzipped) with format:
         Gene_stable_ID, Chromosome/scaffold_name, Gene_start_(bp), Gene_end_(bp), Strand, Gene_name, Gene_type
+        If snapshot_dir is given the parsed database is saved there in a binary snapshot that is loaded instead
+        of the mart file in later runs, until the mart file changes. A snapshot that can not be read or written
+        is skipped (the mart file is parsed).
         :param mart_file:
+        :param snapshot_dir: snapshot directory or None to always parse the mart file
         :return:
         """
-        f = gzip.open(mart_file, 'r')
-        f.readline()  # skip header
+        if snapshot_dir is not None:
+            self.source_hash = self.__file_hash(mart_file)
+            try:
+                if self.load_snapshot(snapshot_dir, self.source_hash):
+                    return
+            except (IOError, OSError, ValueError, KeyError), e:
+                print 'warning: can not load gene snapshot %s (%s), parsing %s' % (snapshot_dir, e, mart_file)
 
-        for line in f:
-            toks = line.strip().split('\t')
-            chr = toks[1]
+        self.__parse_mart_export(mart_file)
+        stat = os.stat(mart_file)
+        self.source_stamp = (os.path.abspath(mart_file), stat.st_size, int(stat.st_mtime))
 
-            if chr not in self.valid_chrs:
-                continue
+        if snapshot_dir is not None:
+            try:
+                self.save_snapshot(snapshot_dir)
+            except (IOError, OSError), e:
+                print 'warning: can not save gene snapshot %s (%s)' % (snapshot_dir, e)
+
+    @staticmethod
+    def __file_hash(file_path):
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def __parse_mart_export(self, mart_file):
+        chr_codes = {chr: i for i, chr in enumerate(self.valid_chrs)}
+        type_codes = {}
+        chrs, starts, ends, strands, types = [], [], [], [], []
+        columns = (self.names, chrs, starts, ends, strands, types)
+        num_duplicates = 0
+
+        with InputReader(mart_file) as f:
+            f.readline()  # skip header
+
+            for line in f:
+                toks = line.strip().split('\t')
+                chr = toks[1]
+
+                if chr not in chr_codes:
+                    continue
+
+                gene_type = toks[6]
+                if gene_type not in type_codes:
+                    type_codes[gene_type] = len(self.type_names)
+                    self.type_names.append(gene_type)
+
+                row = (toks[5], chr_codes[chr], int(toks[2]), int(toks[3]), int(toks[4]), type_codes[gene_type])
+                idx = self.gene_index.get(toks[0])
+                if idx is None:
+                    idx = len(self.ids)
+                    self.gene_index[toks[0]] = idx
+                    self.ids.append(toks[0])
+                    for column, value in zip(columns, row):
+                        column.append(value)
+                else:
+                    # repeated gene id: the last row wins
+                    num_duplicates += 1
+                    for column, value in zip(columns, row):
+                        column[idx] = value
+                self.name_index[toks[5].upper()] = idx
+
+        if num_duplicates > 0:
+            print 'warning: %i repeated gene ids in %s, the last row of each gene was kept' % (num_duplicates,
+                                                                                             mart_file)
 
-            gene = Gene(id=toks[0], name=toks[5], chr=chr, start=int(toks[2]), end=int(toks[3]),
-                        strand=int(toks[4]), type=toks[6])
-            self.gene_index[gene.id] = gene
-            self.name_index[gene.name.upper()] = gene
-            chr_list = self.chr_index.get(gene.chr, [])  # create if new
-            self.chr_index[gene.chr] = chr_list
-            chr_list.append(gene)
+        self.chrs = np.array(chrs, dtype=np.int8)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.strands = np.array(strands, dtype=np.int8)
+        self.types = np.array(types, dtype=np.int16)
+        self.__build_chr_index()
 
+    def save_snapshot(self, snapshot_dir):
+        """
+        Save the database in a versioned binary snapshot: a directory with a .npy file for each array (strings as
+        fixed width byte arrays) and a meta.json with the hash of the source mart file.
+        """
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(snapshot_dir)))
+        try:
+            for field in self.SNAPSHOT_ARRAYS:
+                np.save(os.path.join(tmp_dir, field + '.npy'), getattr(self, field))
+            for field in self.SNAPSHOT_STRINGS:
+                np.save(os.path.join(tmp_dir, field + '.npy'), np.array(getattr(self, field), dtype=np.string_))
+
+            f = open(os.path.join(tmp_dir, 'meta.json'), 'w')
+            json.dump({'version': self.SNAPSHOT_VERSION, 'source_hash': self.source_hash, 'num_genes': len(self.ids)},
+                      f)
+            f.close()
+
+            if os.path.isdir(snapshot_dir):
+                shutil.rmtree(snapshot_dir)
+            os.rename(tmp_dir, snapshot_dir)
+        except (IOError, OSError):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def load_snapshot(self, snapshot_dir, source_hash=None):
+        """
+        Load a snapshot saved by 'save_snapshot', numeric arrays are memory mapped
+        :param snapshot_dir:
+        :param source_hash: expected hash of the source mart file (None to skip the check)
+        :return: True if loaded, False if the snapshot does not exist or is outdated
+        """
+        meta_file = os.path.join(snapshot_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return False
+
+        f = open(meta_file, 'r')
+        meta = json.load(f)
         f.close()
 
-        # sort chr lists by position
-        for chr in self.chr_index.keys():
-            self.chr_index[chr] = sorted(self.chr_index[chr], key=lambda g: g.start)
+        if meta['version'] != self.SNAPSHOT_VERSION or (source_hash is not None and meta['source_hash'] != source_hash):
+            return False
 
-    def get_by_id(self, id):
+        # read every field before changing the database, so a failed load leaves it empty
+        fields = {field: np.load(os.path.join(snapshot_dir, field + '.npy'), mmap_mode='r')
+                  for field in self.SNAPSHOT_ARRAYS}
+        fields.update({field: np.load(os.path.join(snapshot_dir, field + '.npy')).tolist()
+                       for field in self.SNAPSHOT_STRINGS})
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+        self.source_hash = meta['source_hash']
+        self.source_stamp = meta['source_hash']
+        self.gene_index = {id: idx for idx, id in enumerate(self.ids)}
+        self.name_index = {}
+        for idx, name in enumerate(self.names):
+            self.name_index[name.upper()] = idx
+        self.__build_chr_index()
+        return True
+
+    def __build_chr_index(self):
+        # sort chr genes by position
+        for code, chr in enumerate(self.valid_chrs):
+            chr_genes = np.flatnonzero(self.chrs == code)
+            if len(chr_genes) == 0:
+                continue
+            self.chr_index[chr] = chr_genes[np.argsort(self.starts[chr_genes], kind='mergesort')]
+            self.chr_starts[chr] = self.starts[self.chr_index[chr]]
+            self.chr_max_length[chr] = int(np.max(self.ends[chr_genes] - self.starts[chr_genes]))
+
+    def get_gene(self, idx):
+        return Gene(id=self.ids[idx], name=self.names[idx], chr=self.valid_chrs[self.chrs[idx]],
+                    start=int(self.starts[idx]), end=int(self.ends[idx]), strand=int(self.strands[idx]),
+                    type=self.type_names[self.types[idx]])
+
+    def get_index(self, id):
         return self.gene_index.get(id)
 
+    def get_by_id(self, id):
+        idx = self.gene_index.get(id)
+        return self.get_gene(idx) if idx is not None else None
+
     def get_chr_genes(self, chr):
+        chr_genes = self.chr_index.get(chr)
+        return map(self.get_gene, chr_genes) if chr_genes is not None else None
+
+    def get_chr_gene_indices(self, chr):
         return self.chr_index.get(chr)
 
+    def get_mask(self, gene_ids):
+        """
+        Boolean mask (indexed by gene index) of a list of gene ids, unknown ids are ignored
+        """
+        mask = np.zeros(len(self.ids), dtype=bool)
+        indices = [self.gene_index[id] for id in gene_ids if id in self.gene_index]
+        mask[indices] = True
+        return mask
+
+    def get_ids(self, mask):
+        return [self.ids[idx] for idx in np.flatnonzero(mask)]
+
     def get_difference(self, gene_ids):
-        diff_set = []
-        for db_id in self.gene_index:
-            if db_id not in gene_ids:
-                diff_set.append(db_id)
-        return diff_set
+        return self.get_ids(~self.get_mask(gene_ids))
 
-    def get_by_name(self, name):
+    def get_num_genes(self):
+        return len(self.ids)
+
+    def get_index_by_name(self, name):
         return self.name_index.get(name.upper())
+
+    def get_by_name(self, name):
+        idx = self.get_index_by_name(name)
+        return self.get_gene(idx) if idx is not None else None
+
+    def get_genes_in_range(self, chr, start, end):
+        """
+        Indices of the genes of a chromosome overlapping the range [start, end)
+        :return: array of gene indices sorted by gene start
+        """
+        chr_genes = self.chr_index.get(chr)
+        if chr_genes is None:
+            return np.zeros(0, dtype=np.int64)
+        chr_starts = self.chr_starts[chr]
+        lo = np.searchsorted(chr_starts, start - self.chr_max_length[chr], side='left')
+        hi = np.searchsorted(chr_starts, end, side='left')
+        candidates = chr_genes[lo:hi]
+        return candidates[self.ends[candidates] >= start]
@@ -0,0 +1,118 @@
+import sys
+import time
+import email.utils
+import threading
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        """
+        Thread safe token bucket limiter shared by all in-flight requests
+        :param rate: tokens (requests) per second
+        :param burst: bucket capacity, defaults to rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else rate)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # blocks until a token is available
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # stop handing out tokens for some seconds (e.g. 'Retry-After' of the server)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0
+
+
+class HttpTransport(object):
+    def __init__(self, reqs_per_sec=15, max_workers=4, max_retries=3):
+        """
+        HTTP transport with a pool of keep-alive connections, a shared rate limiter and concurrent requests
+        :param reqs_per_sec: max number of requests per second (over all the workers)
+        :param max_workers: number of concurrent requests
+        :param max_retries: max number of retries of a rate limited (429) request
+        """
+        self.limiter = RateLimiter(reqs_per_sec)
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, headers=None, params=None, data=None):
+        """
+        Performs a request and returns the decoded json response or None on error
+        """
+        retries = 0
+        while True:
+            self.limiter.acquire()
+            try:
+                r = self.session.request(method, url, headers=headers, params=params, data=data)
+            except requests.RequestException, e:
+                sys.stderr.write('Request failed for {0}: {1}\n'.format(url, e))
+                return None
+
+            # check if we are being rate limited by the server
+            if r.status_code == 429 and retries < self.max_retries:
+                self.limiter.pause(self.__retry_after(r.headers.get('Retry-After')))
+                retries += 1
+                continue
+
+            if not r.ok:
+                sys.stderr.write('Request failed for {0}: Status code: {1} Reason: {2}\n'.format(
+                    url, r.status_code, r.reason))
+                return None
+
+            return r.json() if r.content else None
+
+    @staticmethod
+    def __retry_after(value, default=1.0):
+        # seconds to wait from a 'Retry-After' header, a number of seconds or an HTTP-date (RFC 7231)
+        if value is None:
+            return default
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return default
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+    def map(self, func, items):
+        """
+        Applies func to every item using max_workers concurrent threads
+        :return: list of results in the order of items
+        """
+        if self.max_workers <= 1 or len(items) <= 1:
+            return map(func, items)
+        pool = ThreadPool(min(self.max_workers, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        self.session.close()
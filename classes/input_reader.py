@@ -0,0 +1,196 @@
+import zlib
+import struct
+import threading
+import Queue
+import cStringIO
+from multiprocessing.pool import ThreadPool
+
+
+class InputReader(object):
+    GZIP_MAGIC = '\x1f\x8b'
+    BGZF_BLOCKS = 64  # BGZF blocks decompressed at once
+
+    def __init__(self, file_path, block_size=1 << 22, max_queued_bytes=1 << 26, threads=4):
+        """
+        Line reader for plain, gzip and BGZF text files. Decompression runs in a background thread (zlib releases
+        the GIL) that hands blocks of lines to the parser through a queue bounded by the size of the queued data,
+        BGZF blocks are decompressed in parallel by a pool of threads. Iterating over the reader returns lines (with
+        end of line) like a file.
+        :param file_path:
+        :param block_size: bytes read from file at once
+        :param max_queued_bytes: max size of the decompressed data waiting in the queue, a single block larger
+        than it is still queued when the queue is empty
+        :param threads: number of threads used to decompress BGZF files
+        """
+        self.file_path = file_path
+        self.block_size = block_size
+        self.max_queued_bytes = max_queued_bytes
+        self.threads = threads
+        self.queue = Queue.Queue()
+        self.queued_bytes = 0
+        self.space = threading.Condition()  # notified when blocks leave the queue or the reader is closed
+        self.stopped = threading.Event()
+        self.finished = False  # end of file reached by the consumer
+        self.file = open(file_path, 'rb')
+        self.lines = iter([])
+        self.worker = threading.Thread(target=self.__produce)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            for line in self.lines:
+                return line
+            block = self.__get_block()
+            if block is None:
+                raise StopIteration
+            self.lines = iter(block)
+
+    def readline(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return ''
+
+    def iter_blocks(self):
+        """
+        Generator of blocks (lists) of lines
+        """
+        block = list(self.lines)
+        self.lines = iter([])
+        if block:
+            yield block
+        while True:
+            block = self.__get_block()
+            if block is None:
+                return
+            yield block
+
+    def __get_block(self):
+        if self.finished:
+            return None
+        block, size = self.queue.get()
+        with self.space:
+            self.queued_bytes -= size
+            self.space.notify()
+        if isinstance(block, Exception):
+            raise block
+        self.finished = block is None
+        return block
+
+    def __put(self, item, size=0):
+        # blocks while the queue is full, returns False if the reader was closed
+        with self.space:
+            while self.queued_bytes > 0 and self.queued_bytes + size > self.max_queued_bytes:
+                if self.stopped.is_set():
+                    return False
+                self.space.wait(0.1)
+            if self.stopped.is_set():
+                return False
+            self.queued_bytes += size
+        self.queue.put((item, size))
+        return True
+
+    def __produce(self):
+        try:
+            rest = ''
+            for data in self.__iter_data():
+                # split complete lines, keeping the end of line like file iteration
+                data = rest + data
+                end = data.rfind('\n') + 1
+                rest = data[end:]
+                if end and not self.__put(cStringIO.StringIO(data[:end]).readlines(), end):
+                    return
+            if rest:
+                self.__put([rest], len(rest))
+            self.__put(None)
+        except Exception, e:
+            self.__put(e)
+
+    def __iter_data(self):
+        # generator of decompressed data blocks
+        head = self.file.read(18)
+        self.file.seek(0)
+
+        if not head.startswith(self.GZIP_MAGIC):
+            for data in iter(lambda: self.file.read(self.block_size), ''):
+                yield data
+        elif self.__is_bgzf(head):
+            for data in self.__iter_bgzf_data():
+                yield data
+        else:
+            for data in self.__iter_gzip_data():
+                yield data
+
+    @staticmethod
+    def __is_bgzf(head):
+        # gzip header with FEXTRA flag and a 'BC' subfield
+        return len(head) >= 18 and ord(head[3]) & 4 and head[12:14] == 'BC'
+
+    def __iter_gzip_data(self):
+        # decompress (multi member) gzip data
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for raw in iter(lambda: self.file.read(self.block_size), ''):
+            data = decomp.decompress(raw)
+            while decomp.unused_data:
+                # a new gzip member starts
+                unused = decomp.unused_data
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += decomp.decompress(unused)
+            yield data
+        yield decomp.flush()
+
+    def __read_bgzf_block(self):
+        # returns the raw deflate data of a BGZF block or None at end of file
+        header = self.file.read(12)
+        if len(header) < 12:
+            return None
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.file.read(xlen)
+        bsize = None
+        pos = 0
+        while pos < xlen:
+            sub_id = extra[pos:pos + 2]
+            sub_len = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+            if sub_id == 'BC':
+                bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+            pos += 4 + sub_len
+        if bsize is None:
+            raise IOError('Invalid BGZF block in %s' % self.file_path)
+        cdata = self.file.read(bsize - xlen - 19)
+        self.file.read(8)  # crc32 and isize
+        return cdata
+
+    def __iter_bgzf_data(self):
+        pool = ThreadPool(self.threads)
+        try:
+            while not self.stopped.is_set():
+                blocks = []
+                while len(blocks) < self.BGZF_BLOCKS:
+                    cdata = self.__read_bgzf_block()
+                    if cdata is None:
+                        break
+                    blocks.append(cdata)
+                if not blocks:
+                    break
+                yield ''.join(pool.map(lambda cdata: zlib.decompress(cdata, -zlib.MAX_WBITS), blocks))
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        self.stopped.set()
+        # unblock the worker if it is waiting in a full queue
+        with self.space:
+            self.space.notify()
+        self.worker.join()
+        self.file.close()
@@ -1,27 +1,66 @@
 import os
-import gzip
 import numpy as np
+from classes.input_reader import InputReader
+from classes.intensity_matrix import IntensityMatrix
 
 
 class Intensities(object):
     @staticmethod
-    def load_birdseed_summary_intensities(path, limit=-1):
+    def load_birdseed_summary_intensities(path, limit=-1, probe_ids=None):
+        """
+        Load the intensities of a birdseed summary file
+        :param path:
+        :param limit: max number of probes read (-1 for no limit)
+        :param probe_ids: None or collection of probe ids to load (e.g. SnpDatabase.get_probe_ids(chr)), a probe id
+        matches the rows with the same id or with the same id and a '-A'/'-B' suffix. The file is read until all of
+        them are found, so if a probe id is repeated in the file the row kept is the last one read before stopping
+        (usually the first one) instead of the last row of the file as when probe_ids is None.
+        :return: dict with keys 'subjects' and 'intensities'
+        """
         sep_char = '\t'
-        f = gzip.open(path, 'r')
-
+        wanted = set(probe_ids) if probe_ids is not None else None
+        pending = set(wanted) if wanted is not None else None  # probe ids not found yet
+        alleles = {}  # probe id to alleles found
         intensities = {}  # dict with key=probe_id and value=np.array of intensities
         num_read = 0
-        for line in f:
-            if line.startswith('#'):
-                continue  # skip comment
-            elif line.startswith('probeset_id'):
-                subjects = map(lambda s: os.path.splitext(s)[0], line.split(sep_char)[1:])
-            else:
-                toks = line.split(sep_char)
-                intensities[toks[0]] = np.array(map(lambda i: float(i), toks[1:]))
-                num_read += 1
-            if num_read == limit:
-                break
 
-        f.close()
+        with InputReader(path) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue  # skip comment
+                elif line.startswith('probeset_id'):
+                    subjects = map(lambda s: os.path.splitext(s)[0], line.split(sep_char)[1:])
+                else:
+                    if wanted is not None:
+                        probe_id = line[:line.find(sep_char)]
+                        if probe_id in wanted:
+                            pending.discard(probe_id)
+                        elif probe_id[-2:] in ('-A', '-B') and probe_id[:-2] in wanted:
+                            alleles.setdefault(probe_id[:-2], set()).add(probe_id[-1])
+                            if len(alleles[probe_id[:-2]]) == 2:
+                                pending.discard(probe_id[:-2])
+                        else:
+                            continue  # not wanted, skip tokenizing
+
+                    toks = line.split(sep_char)
+                    intensities[toks[0]] = np.array(map(lambda i: float(i), toks[1:]))
+                    num_read += 1
+                    if wanted is not None and not pending:
+                        break
+                if num_read == limit:
+                    break
         return {'subjects': subjects, 'intensities': intensities}
+
+    @staticmethod
+    def open_birdseed_summary_matrix(path, matrix_dir=None):
+        """
+        Open the intensities of a birdseed summary file as a memory mapped IntensityMatrix. The summary file is
+        converted the first time (or when it changes) to the matrix directory.
+        :param path: birdseed summary file
+        :param matrix_dir: matrix directory, defaults to '<path>.matrix'
+        :return: IntensityMatrix
+        """
+        matrix_dir = path + '.matrix' if matrix_dir is None else matrix_dir
+        if IntensityMatrix.is_valid(matrix_dir, path):
+            return IntensityMatrix(matrix_dir)
+        return IntensityMatrix.build(path, matrix_dir)
@@ -0,0 +1,146 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+from classes.input_reader import InputReader
+
+
+class IntensityMatrix(object):
+    VERSION = 1
+    BLOCK_ROWS = 1 << 14  # rows converted and written at once
+
+    def __init__(self, matrix_dir):
+        """
+        Intensities of a birdseed summary file stored on disk as a dense float32 matrix (probes x subjects) that is
+        opened with np.memmap, rows are read without loading the whole file. Probe ids are kept sorted (with their
+        row) in a memory mapped array and looked up with binary search.
+        :param matrix_dir: directory created by 'build'
+        """
+        self.matrix_dir = matrix_dir
+        f = open(os.path.join(matrix_dir, 'meta.json'), 'r')
+        self.meta = json.load(f)
+        f.close()
+
+        f = open(os.path.join(matrix_dir, 'subjects.txt'), 'r')
+        self.subjects = [line.rstrip('\n') for line in f]
+        f.close()
+
+        self.probe_ids = np.load(os.path.join(matrix_dir, 'probe_ids.npy'), mmap_mode='r')
+        self.probe_rows = np.load(os.path.join(matrix_dir, 'probe_rows.npy'), mmap_mode='r')
+        shape = (self.meta['num_probes'], len(self.subjects))
+        if shape[0] > 0:
+            self.matrix = np.memmap(os.path.join(matrix_dir, 'matrix.bin'), dtype=np.float32, mode='r', shape=shape)
+        else:
+            self.matrix = np.zeros(shape, dtype=np.float32)
+
+    @staticmethod
+    def source_stamp(source_file):
+        stat = os.stat(source_file)
+        return {'name': os.path.basename(source_file), 'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+    @classmethod
+    def is_valid(cls, matrix_dir, source_file=None):
+        """
+        :return: True if the matrix exists, has the current version and was built from source_file (if given)
+        """
+        meta_file = os.path.join(matrix_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return False
+        f = open(meta_file, 'r')
+        meta = json.load(f)
+        f.close()
+        if meta['version'] != cls.VERSION:
+            return False
+        return source_file is None or meta['source'] == cls.source_stamp(source_file)
+
+    @classmethod
+    def build(cls, summary_file, matrix_dir):
+        """
+        Convert a birdseed summary file (probeset_id and one intensity column per subject) to a matrix directory
+        :param summary_file:
+        :param matrix_dir: output directory (replaced if it exists, left untouched if the conversion fails)
+        :return: the IntensityMatrix
+        """
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(matrix_dir)))
+        try:
+            cls.__write_matrix(summary_file, tmp_dir)
+            if os.path.isdir(matrix_dir):
+                shutil.rmtree(matrix_dir)
+            os.rename(tmp_dir, matrix_dir)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return cls(matrix_dir)
+
+    @classmethod
+    def __write_matrix(cls, summary_file, out_dir):
+        # writes the files of a matrix directory to out_dir
+        sep_char = '\t'
+        out = open(os.path.join(out_dir, 'matrix.bin'), 'wb')
+        subjects = None
+        probe_ids = []
+        rows = []
+
+        try:
+            with InputReader(summary_file) as f:
+                for line in f:
+                    if line.startswith('#'):
+                        continue  # skip comment
+                    elif line.startswith('probeset_id'):
+                        subjects = map(lambda s: os.path.splitext(s)[0], line.split(sep_char)[1:])
+                    else:
+                        toks = line.split(sep_char, 1)
+                        row = np.fromstring(toks[1], dtype=np.float32, sep=sep_char)
+                        if subjects is None or len(row) != len(subjects):
+                            raise ValueError('Bad intensities row for %s in %s' % (toks[0], summary_file))
+                        probe_ids.append(toks[0])
+                        rows.append(row)
+                        if len(rows) == cls.BLOCK_ROWS:
+                            np.vstack(rows).tofile(out)
+                            rows = []
+
+            if rows:
+                np.vstack(rows).tofile(out)
+        finally:
+            out.close()
+
+        probe_ids = np.array(probe_ids, dtype=np.string_)
+        # sorted probe ids, a repeated probe id points to its last row
+        order = np.argsort(probe_ids, kind='mergesort')
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = probe_ids[order[1:]] != probe_ids[order[:-1]]
+        np.save(os.path.join(out_dir, 'probe_ids.npy'), probe_ids[order[last]])
+        np.save(os.path.join(out_dir, 'probe_rows.npy'), order[last].astype(np.int64))
+
+        f = open(os.path.join(out_dir, 'subjects.txt'), 'w')
+        for subject in subjects or []:
+            f.write(subject + '\n')
+        f.close()
+
+        f = open(os.path.join(out_dir, 'meta.json'), 'w')
+        json.dump({'version': cls.VERSION, 'num_probes': len(probe_ids), 'source': cls.source_stamp(summary_file)},
+                  f)
+        f.close()
+
+    def get_row_index(self, probe_id):
+        """
+        :return: row of a probe id (e.g. 'SNP_A-1234567-A') or None if not found
+        """
+        idx = np.searchsorted(self.probe_ids, probe_id)
+        if idx < len(self.probe_ids) and self.probe_ids[idx] == probe_id:
+            return int(self.probe_rows[idx])
+        return None
+
+    def get(self, probe_id, default=None):
+        """
+        :return: intensities of a probe id (a read only view of the matrix row) or default if not found
+        """
+        row = self.get_row_index(probe_id)
+        return self.matrix[row] if row is not None else default
+
+    def __contains__(self, probe_id):
+        return self.get_row_index(probe_id) is not None
+
+    def get_num_probes(self):
+        return len(self.probe_ids)
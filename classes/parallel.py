@@ -0,0 +1,47 @@
+import itertools
+import multiprocessing
+
+# function and shared objects of the running 'run_jobs', inherited by the worker processes when they are forked
+__state = {}
+
+
+def __run_job(item):
+    return __state['func'](__state['shared'], item)
+
+
+def run_jobs(func, items, jobs=1, shared=None, chunksize=1):
+    """
+    Runs func(shared, item) for every item in a pool of worker processes, yielding the results as they finish
+    (in completion order when jobs > 1, in items order otherwise). The shared objects are not pickled: the workers
+    inherit them through fork, so they must be read only. The pool is closed and the shared objects released when
+    the results are exhausted, pending jobs are discarded when a job fails or the generator is closed early.
+    :param func: module level function (picklable by name) of (shared, item)
+    :param items: list of job items
+    :param jobs: number of worker processes, 1 runs the jobs in the calling process
+    :param shared: objects shared with the workers, usually a dict
+    :param chunksize: number of consecutive items sent together to the same worker
+    :return: generator of results
+    """
+    if __state:
+        raise RuntimeError('run_jobs is already running')
+    __state.update({'func': func, 'shared': shared})
+
+    pool = None
+    try:
+        if jobs > 1 and len(items) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(items)))
+            results = pool.imap_unordered(__run_job, items, chunksize=chunksize)
+        else:
+            results = itertools.imap(__run_job, items)
+
+        for res in results:
+            yield res
+    except BaseException:  # failed job or generator closed early, pending jobs are discarded
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        __state.clear()
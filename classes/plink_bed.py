@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class PlinkBed(object):
+    MAGIC = '\x6c\x1b'
+    SNP_MAJOR = '\x01'
+    MISSING = -1  # genotype value for missing
+    BLOCK_SNPS = 4096  # snps decoded at once
+
+    # genotype (number of A1 alleles) of each 2 bit code: 00 hom A1, 01 missing, 10 het, 11 hom A2
+    CODE_GENOTYPES = np.array([2, MISSING, 1, 0], dtype=np.int8)
+
+    def __init__(self, base_path):
+        """
+        Reader of a PLINK1 binary fileset (.bed, .bim and .fam). The SNP-major .bed file is memory mapped and blocks
+        of snps are decoded on demand, per snp missing and allele counts are computed with lookup tables on the
+        packed bytes.
+        :param base_path: path of the fileset without extension
+        """
+        self.base_path = base_path
+        self.snps = self.__read_table(base_path + '.bim')  # chr, id, cm, position, a1, a2
+        self.fam = self.__read_table(base_path + '.fam')  # fid, iid, father, mother, sex, phenotype
+        self.num_snps = len(self.snps)
+        self.num_samples = len(self.fam)
+        self.bytes_per_snp = (self.num_samples + 3) / 4
+
+        f = open(base_path + '.bed', 'rb')
+        header = f.read(3)
+        f.close()
+        if header[:2] != self.MAGIC:
+            raise IOError('%s.bed is not a PLINK bed file' % base_path)
+        if header[2] != self.SNP_MAJOR:
+            raise IOError('%s.bed is not in SNP-major mode' % base_path)
+
+        if self.num_snps * self.bytes_per_snp > 0:
+            self.bed = np.memmap(base_path + '.bed', dtype=np.uint8, mode='r', offset=3,
+                                 shape=(self.num_snps, self.bytes_per_snp))
+        else:
+            self.bed = np.zeros((self.num_snps, self.bytes_per_snp), dtype=np.uint8)
+
+        # byte to the genotypes of its 4 samples
+        codes = (np.arange(256)[:, np.newaxis] >> (2 * np.arange(4))) & 3
+        self.byte_genotypes = self.CODE_GENOTYPES[codes]
+
+    @staticmethod
+    def __read_table(file_path):
+        f = open(file_path, 'r')
+        rows = [line.split() for line in f if line.strip()]
+        f.close()
+        return rows
+
+    def get_snp_ids(self):
+        return [snp[1] for snp in self.snps]
+
+    def get_sample_ids(self):
+        return [sample[1] for sample in self.fam]
+
+    def get_genotypes(self, start=0, stop=None):
+        """
+        Decode the genotypes of a range of snps
+        :return: int8 array (snps x samples) with the number of A1 alleles, MISSING for missing genotypes
+        """
+        stop = self.num_snps if stop is None else min(stop, self.num_snps)
+        block = np.asarray(self.bed[start:stop])
+        genotypes = self.byte_genotypes[block].reshape((len(block), self.bytes_per_snp * 4))
+        return genotypes[:, :self.num_samples]
+
+    def __sample_patterns(self, sample_mask):
+        # 4 bit pattern of the selected samples of each byte
+        mask = np.zeros(self.bytes_per_snp * 4, dtype=np.int64)
+        mask[:self.num_samples] = np.ones(self.num_samples, dtype=bool) if sample_mask is None else sample_mask
+        return (mask.reshape((self.bytes_per_snp, 4)) << np.arange(4)).sum(axis=1)
+
+    def __byte_counts(self, genotype):
+        # pattern x byte table with the number of selected samples with a genotype
+        selected = (np.arange(16)[:, np.newaxis] >> np.arange(4)) & 1
+        matches = (self.byte_genotypes == genotype).astype(np.int64)
+        return np.dot(selected, matches.T).astype(np.uint8)
+
+    def __count(self, tables, sample_mask):
+        # sums the tables (one per count) over the selected samples of every snp
+        patterns = self.__sample_patterns(sample_mask)
+        counts = [np.zeros(self.num_snps, dtype=np.int64) for table in tables]
+        for start in range(0, self.num_snps, self.BLOCK_SNPS):
+            block = np.asarray(self.bed[start:start + self.BLOCK_SNPS])
+            for i, table in enumerate(tables):
+                counts[i][start:start + len(block)] = table[patterns, block].sum(axis=1, dtype=np.int64)
+        return counts
+
+    def get_missing_counts(self, sample_mask=None):
+        """
+        Number of missing genotypes of each snp
+        :param sample_mask: None or boolean array (one value per sample in .fam order) of the samples counted
+        :return: int64 array
+        """
+        return self.__count([self.__byte_counts(self.MISSING)], sample_mask)[0]
+
+    def get_allele_counts(self, sample_mask=None):
+        """
+        Number of A1 and A2 alleles of each snp (missing genotypes are not counted)
+        :param sample_mask: None or boolean array (one value per sample in .fam order) of the samples counted
+        :return: a tuple of int64 arrays (A1 counts, A2 counts)
+        """
+        hom_a1, het, hom_a2 = [self.__byte_counts(genotype) for genotype in (2, 1, 0)]
+        return tuple(self.__count([2 * hom_a1 + het, 2 * hom_a2 + het], sample_mask))
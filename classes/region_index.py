@@ -0,0 +1,135 @@
+import bisect
+import numpy as np
+
+
+class RegionIndex(object):
+    def __init__(self, region, wsize):
+        """
+        Index of the windows (of size wsize) centered in the positions of a region. A feature located at
+        chr:start-end matches a window when any of its ends is closer than wsize/2 to the window center.
+        :param region: dict of {chr: [p1, p2, ...]}, positions can also be dicts with a 'pos' key
+        :param wsize: window size
+        """
+        self.region = region
+        self.wsize = wsize
+        self.dist = wsize / 2
+        self.chr_index = {}
+        self.__gene_hits = None  # cached (genes_db, mask of genes overlapping any window, number of them)
+
+        for chr in region.keys():
+            pos_objs = region[chr]
+            positions = [pos_obj['pos'] if type(pos_obj) is dict else pos_obj for pos_obj in pos_objs]
+            order = sorted(range(len(positions)), key=lambda i: positions[i])
+            self.chr_index[chr] = {
+                'positions': [positions[i] for i in order],  # sorted positions
+                'array': np.array([positions[i] for i in order]),
+                'objects': pos_objs,
+                'min_order': self.__build_min_table(order)
+            }
+
+    @staticmethod
+    def __build_min_table(order):
+        # sparse table for range minimum queries over the original list order of the sorted positions
+        table = [np.array(order, dtype=np.int64)]
+        k = 1
+        while (1 << k) <= len(order):
+            prev = table[-1]
+            half = 1 << (k - 1)
+            table.append(np.minimum(prev[:-half], prev[half:]))
+            k += 1
+        return table
+
+    @staticmethod
+    def __range_min(table, lo, hi):
+        # minimum of the original order in the sorted range [lo, hi)
+        if lo >= hi:
+            return None
+        k = (hi - lo).bit_length() - 1
+        return min(table[k][lo], table[k][hi - (1 << k)])
+
+    def __window_range(self, positions, point):
+        # range [lo, hi) of sorted positions strictly closer than dist to point
+        lo = bisect.bisect_right(positions, point - self.dist)
+        hi = bisect.bisect_left(positions, point + self.dist)
+        return lo, hi
+
+    def overlaps(self, chr, start, end):
+        """
+        Checks whether a feature located at chr:start-end overlaps any window
+        """
+        data = self.chr_index.get(chr)
+        if data is None:
+            return False
+        positions = data['positions']
+        for point in (start, end):
+            lo, hi = self.__window_range(positions, point)
+            if lo < hi:
+                return True
+        return False
+
+    def find(self, chr, start, end):
+        """
+        Returns the region position (object) of the window overlapped by a feature located at chr:start-end.
+        When several windows overlap, returns the first one in the order of the region list.
+        :return: the position object or None
+        """
+        data = self.chr_index.get(chr)
+        if data is None:
+            return None
+        positions = data['positions']
+        found = None
+        for point in (start, end):
+            lo, hi = self.__window_range(positions, point)
+            idx = self.__range_min(data['min_order'], lo, hi)
+            if idx is not None and (found is None or idx < found):
+                found = idx
+        return data['objects'][found] if found is not None else None
+
+    def overlaps_many(self, chr, starts, ends):
+        """
+        Vectorized version of 'overlaps' for arrays of features located in the same chromosome
+        :return: boolean np.array
+        """
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        data = self.chr_index.get(chr)
+        if data is None:
+            return np.zeros(len(starts), dtype=bool)
+        positions = data['array']
+        mask = np.zeros(len(starts), dtype=bool)
+        for points in (starts, ends):
+            lo = np.searchsorted(positions, points - self.dist, side='right')
+            hi = np.searchsorted(positions, points + self.dist, side='left')
+            mask |= lo < hi
+        return mask
+
+    def get_gene_hits(self, genes_db):
+        """
+        Returns a boolean mask (indexed by gene index) of the genes in genes_db that overlap any window. The mask
+        is computed once and cached, since for a fixed (region, wsize) it does not depend on the genes being tested.
+        :param genes_db: a GeneDatabase
+        :return: boolean np.array
+        """
+        return self.__get_gene_hits(genes_db)[1]
+
+    def get_num_gene_hits(self, genes_db):
+        """
+        Returns the number of genes in genes_db that overlap any window (cached with 'get_gene_hits')
+        :param genes_db: a GeneDatabase
+        :return: int
+        """
+        return self.__get_gene_hits(genes_db)[2]
+
+    def __get_gene_hits(self, genes_db):
+        # cached (genes_db, hits mask, number of hits), computed again for another genes_db
+        if self.__gene_hits is not None and self.__gene_hits[0] is genes_db:
+            return self.__gene_hits
+
+        hits = np.zeros(genes_db.get_num_genes(), dtype=bool)
+        for chr in self.chr_index:
+            chr_genes = genes_db.get_chr_gene_indices(chr)
+            if chr_genes is not None:
+                hits[chr_genes] = self.overlaps_many(chr, genes_db.starts[chr_genes], genes_db.ends[chr_genes])
+
+        self.__gene_hits = (genes_db, hits, int(np.count_nonzero(hits)))
+        return self.__gene_hits
@@ -1,6 +1,10 @@
-import gzip
 import re
 import os
+import multiprocessing
+import numpy as np
+from classes.snp_table import SnpTable
+from classes.input_reader import InputReader
+from classes.dbsnp_index import DbSnpIndex
 
 
 class SnpDatabase(object):
@@ -14,148 +18,242 @@ class SnpDatabase(object):
     F_UCSC_POS = 2
     F_UCSC_CHR = 1
 
+    UCSC_BLOCK_SIZE = 1 << 24  # bytes read at once from UCSC dbSNP dumps
+
     def __init__(self):
-        self.snp_map = {}  # rs_id to position
-        self.snp_map_pos = {}  # position to rs_id
+        self.snp_map = {}  # chr to SnpTable (rs_id, position and extra fields sorted by position)
         self.probe_id_map = {}  # probe_id to rs_id
         self.probe_id_map_direct = {}  # probe_id to rs_id
 
+    def __iter_ucsc_db_snp(self, file_path, valid_chrs, rs_ids=None):
+        """
+        Streams the snps of a UCSC dbSNP dump (plain, gzip or BGZF) reading it in large blocks of lines. Only the
+        needed columns are split from each line, snps of non valid chromosomes and snps not in rs_ids are skipped.
+        :param file_path:
+        :param valid_chrs: list of chromosomes (without 'chr' prefix)
+        :param rs_ids: None or dict of {chr: collection of rs ids}, snps not found in it are skipped
+        :return: generator of tuples (chr, rs_id, position)
+        """
+        chr_names = {'chr' + chro: chro for chro in valid_chrs}
+        max_split = max(self.F_UCSC_CHR, self.F_UCSC_POS, self.F_UCSC_RSID) + 1
+
+        with InputReader(file_path, block_size=self.UCSC_BLOCK_SIZE) as f:
+            for lines in f.iter_blocks():
+                for line in lines:
+                    toks = line.split('\t', max_split)
+                    if len(toks) < max_split:
+                        continue  # empty line
+                    chro = chr_names.get(toks[self.F_UCSC_CHR])
+                    if chro is None:
+                        continue
+                    rs_id = toks[self.F_UCSC_RSID]
+                    if rs_ids is not None and rs_id not in rs_ids[chro]:
+                        continue
+                    yield chro, rs_id, int(toks[self.F_UCSC_POS])
+
     def load_from_ucsc_db_snp(self, file_path):
         valid_chrs = [str(i) for i in range(1, 23)] + ['X', 'Y']
+        chr_snps = {}  # chr to (ids, positions, set of ids)
+
+        for chro, rs_id, pos in self.__iter_ucsc_db_snp(file_path, valid_chrs):
+            if chro not in chr_snps:
+                chr_snps[chro] = ([], [], set([]))
+
+            ids, positions, seen = chr_snps[chro]
+
+            if rs_id not in seen:
+                seen.add(rs_id)
+                ids.append(rs_id)
+                positions.append(pos)
+
+        for chro in chr_snps:
+            self.snp_map[chro] = SnpTable(chr_snps[chro][0], chr_snps[chro][1])
+
+    def add_ucsc_db_snp_position(self, file_path, new_field_name, index_dir=None):
+        """
+        Add the positions of a UCSC dbSNP dump as a new field
+        :param file_path: UCSC dbSNP dump
+        :param new_field_name:
+        :param index_dir: None to scan the dump, or directory of a persistent position index (DbSnpIndex) that is
+        built from the dump the first time (or when the dump changes) and reused by later calls
+        """
+        if index_dir is not None:
+            if DbSnpIndex.is_valid(index_dir, file_path):
+                index = DbSnpIndex(index_dir)
+            else:
+                index = DbSnpIndex.build(index_dir, self.__iter_ucsc_db_snp(file_path, DbSnpIndex.valid_chrs),
+                                         source_file=file_path)
+            self.add_db_snp_index_position(index, new_field_name)
+            return
 
-        with (gzip.open(file_path, 'r') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
-            for line in f:
-                toks = line.split('\t')
-                rs_id = toks[self.F_UCSC_RSID]
-                pos = int(toks[self.F_UCSC_POS])
-                chro = toks[self.F_UCSC_CHR][3:]
-
-                if chro not in valid_chrs:
-                    continue
-
-                if chro not in self.snp_map:
-                    self.snp_map[chro] = {}
-                    self.snp_map_pos[chro] = {}
-
-                if rs_id not in self.snp_map[chro]:
-                    self.snp_map[chro][rs_id] = {'id': rs_id, 'position': pos}
-                    self.snp_map_pos[chro][pos] = rs_id
-
-            f.close()
-
-    def add_ucsc_db_snp_position(self, file_path, new_field_name):
         valid_chrs = self.snp_map.keys()
         count_chr_snps = {chro: {'count': 0} for chro in valid_chrs}
-        with (gzip.open(file_path, 'r') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
-            for line in f:
-                toks = line.split('\t')
-                rs_id = toks[self.F_UCSC_RSID]
-                pos = int(toks[self.F_UCSC_POS])
-                chro = toks[self.F_UCSC_CHR][3:]
+        chr_positions = {chro: {} for chro in valid_chrs}  # row to position
+        rs_ids = {chro: self.snp_map[chro].row_index for chro in valid_chrs}  # only snps in the database
 
-                if chro not in valid_chrs:
-                    continue
+        for chro, rs_id, pos in self.__iter_ucsc_db_snp(file_path, valid_chrs, rs_ids=rs_ids):
+            count_chr_snps[chro]['count'] += 1
+            chr_positions[chro][rs_ids[chro][rs_id]] = pos
 
-                data = self.get_snp_data(chro, rs_id)
+        for chro in chr_positions:
+            self.__set_rows_field(chro, chr_positions[chro], new_field_name)
 
-                if data is not None:
-                    count_chr_snps[chro]['count'] += 1
-                    data[new_field_name] = pos
-
-            f.close()
         print 'Add UCSC dbSNP position:'
         # print number of snps read
         for chro in count_chr_snps:
             print 'Chr', chro, count_chr_snps[chro]['count']
 
-    def load_from_birdseed(self, path, subject):
+    def add_db_snp_index_position(self, index, new_field_name):
+        """
+        Add the positions of a DbSnpIndex as a new field
+        """
+        print 'Add dbSNP index position:'
+        for chro in self.snp_map:
+            table = self.snp_map[chro]
+            rows, positions = index.lookup(chro, table.ids)
+            if len(rows):
+                table.set_values(new_field_name, rows, positions.astype(np.int64))
+            # print number of snps found
+            print 'Chr', chro, len(rows)
+
+    def __set_rows_field(self, chro, row_values, field):
+        # set a field from a dict of row: value
+        rows = row_values.keys()
+        if not rows:
+            return
+        self.snp_map[chro].set_values(field, np.array(rows, dtype=np.int64), [row_values[row] for row in rows])
+
+    def load_from_birdseed(self, path, subject, chrs=None, jobs=1):
+        """
+        Load the snps of the per chromosome birdseed output files of a subject
+        :param path: directory of the birdseed files
+        :param subject:
+        :param chrs: list of chromosomes to load, None to load chromosomes 1 to 22
+        :param jobs: number of processes parsing files concurrently
+        """
         p = re.compile(subject + '\.birdseed-v2.(\w+)\.txt\.gz')
-        files = filter(lambda name: p.match(name), os.listdir(path))
-
-        for i in range(1, 23):
-            chro = str(i)
-            self.snp_map[chro] = {}  # rs_id to position
-            self.snp_map_pos[chro] = {}  # position to rs_id
-            self.probe_id_map[chro] = {}  # probe_id to rs_id
-            file_name = filter(lambda name: p.match(name).groups(0)[0] == chro, files)[0]
-            self.__load_from_birdseed_out(chro, os.path.join(path, file_name))
-
-    def __load_from_birdseed_out(self, chro, file_path):
-        with (gzip.open(file_path, 'r') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
-            for line in f:
-                if not line.startswith('#') and not line.startswith('Probe'):
-                    toks = line.split('\t')
-                    rs_id = toks[self.F_RSID]
-                    probe_id = toks[self.F_PROBEID]
-                    pos = int(toks[self.F_POS])
-
-                    if rs_id not in self.snp_map[chro]:
-                        self.snp_map[chro][rs_id] = {'id': rs_id, 'position': pos}
-                        self.snp_map_pos[chro][pos] = rs_id
-                        self.probe_id_map[chro][probe_id] = rs_id
-                        self.probe_id_map_direct[probe_id] = rs_id
-
-            f.close()
-
-    def load_missing_info(self, path, lmiss_regex='_(\d+)\.lmiss'):
-        p = re.compile(lmiss_regex)
-        files = filter(lambda name: p.match(name), os.listdir(path))
-
-        for i in range(1, 23):
-            chro = str(i)
-            file_name = filter(lambda name: p.match(name).groups(0)[0] == chro, files)[0]
-            self.__load_lmiss_out(chro, os.path.join(path, file_name))
+        chr_files = self.__get_chr_files(path, p)
+        chrs = [str(i) for i in range(1, 23)] if chrs is None else chrs
+        tasks = [(chro, chr_files[chro]) for chro in chrs]
+
+        if jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(_parse_birdseed_out, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_parse_birdseed_out, tasks)
+
+        for chro, ids, positions, probe_ids in results:
+            self.probe_id_map[chro] = dict(zip(probe_ids, ids))  # probe_id to rs_id
+            self.probe_id_map_direct.update(self.probe_id_map[chro])
+            self.snp_map[chro] = SnpTable(ids, positions)
+
+    @staticmethod
+    def __get_chr_files(path, p):
+        # map of chr to file path of the files matching p (chr is the first group)
+        chr_files = {}
+        for name in os.listdir(path):
+            m = p.match(name)
+            if m and m.group(1) not in chr_files:
+                chr_files[m.group(1)] = os.path.join(path, name)
+        return chr_files
+
+    def load_missing_info(self, path, lmiss_regex='_(\d+)\.lmiss', chrs=None):
+        """
+        Load the plink missing output (.lmiss files) of some chromosomes
+        :param path:
+        :param lmiss_regex: regex of the file names, the first group is the chromosome
+        :param chrs: list of chromosomes to load, None to load chromosomes 1 to 22
+        """
+        chr_files = self.__get_chr_files(path, re.compile(lmiss_regex))
+        chrs = [str(i) for i in range(1, 23)] if chrs is None else chrs
+
+        for chro in chrs:
+            self.__load_lmiss_out(chro, chr_files[chro])
 
     def __load_lmiss_out(self, chro, file_path):
-        with (gzip.open(file_path, 'r') if file_path.endswith('.gz') else open(file_path, 'r')) as f:
+        lmiss = {'lmiss.N_MISS': {}, 'lmiss.N_GENO': {}, 'lmiss.F_MISS': {}}  # field to dict of row: value
+
+        with InputReader(file_path) as f:
             f.readline()  # skip header
             for line in f:
                 toks = filter(None, line.split(' '))
                 # fields: CHR SNP N_MISS N_GENO F_MISS
                 rs_id = toks[1]
-                data = self.get_snp_data(chro, rs_id)
-                if data is not None:
-                    data['lmiss'] = {'N_MISS': int(toks[2]), 'N_GENO': int(toks[3]), 'F_MISS': float(toks[4])}
+                row = self.snp_map[chro].get_row(rs_id)
+                if row is not None:
+                    lmiss['lmiss.N_MISS'][row] = int(toks[2])
+                    lmiss['lmiss.N_GENO'][row] = int(toks[3])
+                    lmiss['lmiss.F_MISS'][row] = float(toks[4])
                 else:
                     print 'lmiss: %(snp)s in chr %(chr)s not found' % {'snp': rs_id, 'chr': chro}
 
-            f.close()
+        for field in lmiss:
+            self.__set_rows_field(chro, lmiss[field], field)
 
-    def load_from_map_files(self, path, ped_file_name_regex):
-        p = re.compile(ped_file_name_regex + '\.map')
+    def load_from_map_files(self, path, ped_file_name_regex, ext='map'):
+        """
+        Load the snps of plink .map files (or .bim files of binary filesets with ext='bim')
+        """
+        p = re.compile(ped_file_name_regex + '\.' + ext)
         map_files = filter(lambda name: p.match(name), os.listdir(path))
 
         for map_file in map_files:
             chro = p.match(map_file).groups()[0]
-            self.snp_map[chro] = {}
-            self.snp_map_pos[chro] = {}
+            ids = []
+            positions = []
+            seen = set([])
 
             f = open(os.path.join(path, map_file), 'r')
             for line in f:
                 toks = line.split('\t')
                 rs_id = toks[1]
                 pos = int(toks[3])
-                if rs_id not in self.snp_map[chro]:
-                    self.snp_map[chro][rs_id] = {'id': rs_id, 'position': pos}
-                    self.snp_map_pos[chro][pos] = rs_id
+                if rs_id not in seen:
+                    seen.add(rs_id)
+                    ids.append(rs_id)
+                    positions.append(pos)
             f.close()
 
+            self.snp_map[chro] = SnpTable(ids, positions)
+
     def get_rs_id(self, chro, probe_id):
         if chro is None:
             return self.probe_id_map_direct.get(probe_id)
         return self.probe_id_map[chro].get(probe_id)
 
     def get_snp_data(self, chro, rs_id):
-        return self.snp_map[chro].get(rs_id)
+        """
+        Returns a dict with the data of a snp (a copy, use 'set_snp_field' to modify it) or None if not found
+        """
+        row = self.snp_map[chro].get_row(rs_id)
+        return self.snp_map[chro].get_data(row) if row is not None else None
+
+    def set_snp_field(self, chro, rs_id, field, value):
+        """
+        Set a field of a snp, nested fields use dotted names, e.g: 'lmiss.missing_par'
+        """
+        row = self.snp_map[chro].get_row(rs_id)
+        if row is None:
+            raise KeyError('snp %s not found in chr %s' % (rs_id, chro))
+        self.snp_map[chro].set_value(field, row, value)
+
+    def get_chr_table(self, chro):
+        return self.snp_map[chro]
 
     def get_chr_data(self, chro):
-        return self.snp_map[chro].values()
+        table = self.snp_map[chro]
+        return [table.get_data(row) for row in range(len(table))]
 
     def get_position(self, chro, rs_id):
-        return self.get_snp_data(chro, rs_id)['position']
+        table = self.snp_map[chro]
+        return table.positions[table.get_row(rs_id)].item()
 
     def get_snp_ids(self, chro):
-        return self.snp_map[chro].keys()
+        return list(self.snp_map[chro].ids)
 
     def get_probe_ids(self, chro):
         return self.probe_id_map[chro].keys()
@@ -165,25 +263,57 @@ class SnpDatabase(object):
             print "Chr", chro, len(self.snp_map[chro]), 'snps'
 
     def get_snps_in_region(self, chro, min_pos, max_pos, pos_field='position'):
-        chr_snps = self.snp_map[chro]
-        return filter(lambda rs_id: max_pos > chr_snps[rs_id][pos_field] >= min_pos, chr_snps)
+        table = self.snp_map[chro]
+        return [table.ids[row] for row in table.get_rows_in_range(min_pos, max_pos, pos_field=pos_field)]
 
     def write_position(self, file_path, pos_field):
         f = open(file_path, 'w')
         for chro in self.snp_map:
-            for snp in self.snp_map[chro].values():
-                if snp.get(pos_field) is not None:
-                    f.write(snp['id'] + '\t' + chro + '\t' + str(snp[pos_field]) + '\n')
+            table = self.snp_map[chro]
+            values, present = table.get_values(pos_field)
+            for row in np.flatnonzero(present):
+                f.write(table.ids[row] + '\t' + chro + '\t' + str(values[row].item()) + '\n')
         f.close()
 
     def read_position(self, file_path, pos_field):
+        chr_positions = {chro: {} for chro in self.snp_map}  # row to position
         f = open(file_path, 'r')
         for line in f:
             toks = line.split('\t')
             rs_id = toks[0]
             chro = toks[1]
             pos = int(toks[2])
-            data = self.get_snp_data(chro, rs_id)
-            if data is not None:
-                data[pos_field] = pos
+            row = self.snp_map[chro].get_row(rs_id)
+            if row is not None:
+                chr_positions[chro][row] = pos
         f.close()
+
+        for chro in chr_positions:
+            self.__set_rows_field(chro, chr_positions[chro], pos_field)
+
+
+def _parse_birdseed_out(task):
+    """
+    Parse a birdseed output file (run in worker processes by SnpDatabase.load_from_birdseed)
+    :param task: tuple (chr, file path)
+    :return: tuple (chr, list of rs ids, list of positions, list of probe ids) with the first probe of each rs id
+    """
+    chro, file_path = task
+    ids = []
+    positions = []
+    probe_ids = []
+    seen = set([])
+
+    with InputReader(file_path) as f:
+        for line in f:
+            if not line.startswith('#') and not line.startswith('Probe'):
+                toks = line.split('\t')
+                rs_id = toks[SnpDatabase.F_RSID]
+
+                if rs_id not in seen:
+                    seen.add(rs_id)
+                    ids.append(rs_id)
+                    positions.append(int(toks[SnpDatabase.F_POS]))
+                    probe_ids.append(toks[SnpDatabase.F_PROBEID])
+
+    return chro, ids, positions, probe_ids
@@ -0,0 +1,99 @@
+import numpy as np
+
+
+class SnpTable(object):
+    def __init__(self, ids, positions):
+        """
+        SNPs of a chromosome stored in columns and sorted by position. Extra per SNP fields are kept as parallel
+        columns (with a mask of the rows that have a value), nested fields use dotted names (e.g. 'lmiss.F_MISS').
+        :param ids: list of rs ids
+        :param positions: list of positions
+        """
+        order = np.argsort(np.asarray(positions, dtype=np.int64), kind='mergesort')
+        self.ids = [ids[i] for i in order]
+        self.positions = np.asarray(positions, dtype=np.int32)[order]
+        self.row_index = {rs_id: row for row, rs_id in enumerate(self.ids)}
+        self.columns = {}  # field to array of values
+        self.present = {}  # field to boolean mask of rows with value
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_row(self, rs_id):
+        return self.row_index.get(rs_id)
+
+    def get_rows(self, rs_ids):
+        """
+        :return: a tuple (array of rows, array of indexes in rs_ids) of the ids found
+        """
+        rows = []
+        found = []
+        for i, rs_id in enumerate(rs_ids):
+            row = self.row_index.get(rs_id)
+            if row is not None:
+                rows.append(row)
+                found.append(i)
+        return np.array(rows, dtype=np.int64), np.array(found, dtype=np.int64)
+
+    def __create_column(self, field, dtype):
+        self.columns[field] = np.zeros(len(self.ids), dtype=dtype)
+        self.present[field] = np.zeros(len(self.ids), dtype=bool)
+
+    def set_values(self, field, rows, values):
+        """
+        Set the values of a field for some rows, the column is created if needed
+        :param field:
+        :param rows: array of rows
+        :param values: array of values (same length as rows)
+        """
+        values = np.asarray(values)
+        if field not in self.columns:
+            self.__create_column(field, np.float64 if values.dtype.kind == 'f' else np.int64)
+        elif values.dtype.kind == 'f' and self.columns[field].dtype.kind != 'f':
+            self.columns[field] = self.columns[field].astype(np.float64)
+        self.columns[field][rows] = values
+        self.present[field][rows] = True
+
+    def set_value(self, field, row, value):
+        self.set_values(field, np.array([row]), np.array([value]))
+
+    def get_values(self, field):
+        """
+        :return: a tuple (array of values, boolean mask of rows with value)
+        """
+        if field == 'position':
+            return self.positions, np.ones(len(self.ids), dtype=bool)
+        if field not in self.columns:
+            return np.zeros(len(self.ids), dtype=np.int64), np.zeros(len(self.ids), dtype=bool)
+        return self.columns[field], self.present[field]
+
+    def get_value(self, field, row):
+        values, present = self.get_values(field)
+        return values[row].item() if present[row] else None
+
+    def get_data(self, row):
+        """
+        Builds a dict with the data of a row, e.g: {'id': rs_id, 'position': pos, 'lmiss': {'N_MISS': 1, ...}}
+        """
+        data = {'id': self.ids[row], 'position': self.positions[row].item()}
+        for field in self.columns:
+            if not self.present[field][row]:
+                continue
+            value = self.columns[field][row].item()
+            if '.' in field:
+                group, sub_field = field.split('.', 1)
+                data.setdefault(group, {})[sub_field] = value
+            else:
+                data[field] = value
+        return data
+
+    def get_rows_in_range(self, min_pos, max_pos, pos_field='position'):
+        """
+        Rows with min_pos <= position < max_pos
+        """
+        if pos_field == 'position':
+            lo = np.searchsorted(self.positions, min_pos, side='left')
+            hi = np.searchsorted(self.positions, max_pos, side='left')
+            return np.arange(lo, hi)
+        values, present = self.get_values(pos_field)
+        return np.flatnonzero(present & (values >= min_pos) & (values < max_pos))
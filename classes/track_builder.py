@@ -0,0 +1,225 @@
+import gzip
+import numpy as np
+from classes.bigwig_writer import BigWigWriter
+
+
+class TrackBuilder(object):
+    AGGREGATIONS = ['mean', 'sum', 'min', 'max', 'count', 'quantile']
+
+    def __init__(self, chr_sizes, window_sizes):
+        """
+        Builds genome tracks of fixed windows from per snp columns of a SnpDatabase. Every track has a field (e.g.
+        'lmiss.F_MISS') and an aggregation of the values of the snps in each window (mean, sum, min, max, count or
+        quantile). All the tracks and window sizes are computed in one pass over the snps of each chromosome.
+        :param chr_sizes: dict of chr to size
+        :param window_sizes: list of window sizes
+        """
+        self.chr_sizes = chr_sizes
+        self.window_sizes = window_sizes
+        self.tracks = []  # list of track definitions
+        self.results = {}  # window size to chr to track name to tuple (values, counts)
+        self.chrs = []  # chromosomes built
+
+    def add_track(self, name, field, aggregation='mean', q=None, title=None):
+        """
+        :param name: track name, used in the output file names
+        :param field: snp field (SnpTable column)
+        :param aggregation: one of AGGREGATIONS
+        :param q: quantile in [0, 1] for aggregation 'quantile' (linear interpolation, as np.percentile)
+        :param title: name written in the track header, defaults to name
+        """
+        if aggregation not in self.AGGREGATIONS:
+            raise ValueError('Unknown aggregation: %s' % aggregation)
+        if aggregation == 'quantile' and (q is None or not 0 <= q <= 1):
+            raise ValueError('Quantile aggregation needs q in [0, 1]')
+        self.tracks.append({'name': name, 'field': field, 'aggregation': aggregation, 'q': q,
+                            'title': title if title is not None else name})
+
+    def get_num_windows(self, chro, window_size):
+        chr_size = self.chr_sizes[chro]
+        return int(chr_size / window_size) + (1 if int(chr_size % window_size) > 0 else 0)
+
+    def build(self, snp_db, pos_field, chrs):
+        """
+        Compute the tracks, positions and fields are read once per chromosome
+        :param snp_db: SnpDatabase
+        :param pos_field: position field
+        :param chrs: list of chromosomes
+        """
+        self.chrs = chrs
+        self.results = {window_size: {} for window_size in self.window_sizes}
+        fields = sorted(set(track['field'] for track in self.tracks))
+        # fields with order statistics (snps sorted by value)
+        sorted_fields = set(track['field'] for track in self.tracks
+                            if track['aggregation'] in ('min', 'max', 'quantile'))
+
+        for chro in chrs:
+            table = snp_db.get_chr_table(chro)
+            positions, with_pos = table.get_values(pos_field)
+            columns = {field: table.get_values(field) for field in fields}
+
+            for window_size in self.window_sizes:
+                num_windows = self.get_num_windows(chro, window_size)
+                bin_idx = (positions / float(window_size)).astype(np.int64)
+                if np.any(bin_idx[with_pos] >= num_windows):
+                    raise IndexError('position out of chr%s windows' % chro)
+
+                # snps of each field (sorted by window and value if needed), shared by the tracks of the field
+                binned = {}
+                for field in fields:
+                    values, present = columns[field]
+                    rows = np.flatnonzero(with_pos & present)
+                    if field in sorted_fields:
+                        rows = rows[np.lexsort((values[rows], bin_idx[rows]))]
+                    counts = np.bincount(bin_idx[rows], minlength=num_windows)
+                    binned[field] = (bin_idx[rows], values[rows], counts)
+
+                self.results[window_size][chro] = {
+                    track['name']: self.__aggregate(track, binned[track['field']], num_windows)
+                    for track in self.tracks}
+
+    @staticmethod
+    def __aggregate(track, binned, num_windows):
+        # returns a tuple (array of values, array of counts) of the windows
+        bin_idx, values, counts = binned
+        aggregation = track['aggregation']
+        starts = np.cumsum(counts) - counts  # first sorted snp of each window
+        filled = counts > 0
+
+        if aggregation == 'count':
+            return counts, counts
+        elif aggregation in ('sum', 'mean'):
+            sums = np.bincount(bin_idx, weights=values, minlength=num_windows)
+            if aggregation == 'mean':
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    return np.where(filled, sums / counts, 0), counts
+            return (sums.astype(values.dtype) if values.dtype.kind != 'f' else sums), counts
+
+        result = np.zeros(num_windows, dtype=values.dtype if aggregation in ('min', 'max') else np.float64)
+        if aggregation == 'min':
+            result[filled] = values[starts[filled]]
+        elif aggregation == 'max':
+            result[filled] = values[starts[filled] + counts[filled] - 1]
+        else:
+            pos = track['q'] * (counts[filled] - 1)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.ceil(pos).astype(np.int64)
+            lo_values = values[starts[filled] + lo].astype(np.float64)
+            hi_values = values[starts[filled] + hi].astype(np.float64)
+            result[filled] = lo_values + (hi_values - lo_values) * (pos - lo)
+        return result, counts
+
+    def get_track(self, window_size, chro, name):
+        """
+        :return: a tuple (array of values, array of counts) with a value per window
+        """
+        return self.results[window_size][chro][name]
+
+    def iter_values(self, window_size, chro, name):
+        """
+        Generator of the values of a track as text, empty windows are written as '0'
+        """
+        values, counts = self.get_track(window_size, chro, name)
+        for value, count in zip(values.tolist(), counts.tolist()):
+            yield str(value) if count > 0 else '0'
+
+    def __get_tracks(self, names):
+        # track definitions of a list of names (all the tracks if None)
+        if names is None:
+            return self.tracks
+        tracks = {track['name']: track for track in self.tracks}
+        return [tracks[name] for name in names]
+
+    def __get_windows(self, window_size, chro):
+        # arrays of starts and ends of the windows of a chromosome
+        starts = (np.arange(self.get_num_windows(chro, window_size)) * window_size).astype(np.int64)
+        ends = np.minimum((starts + window_size).astype(np.int64), self.chr_sizes[chro])
+        return starts, ends
+
+    @staticmethod
+    def __write_text(file_name, text, compress):
+        # writes the text in one call, gzip compressed if compress (appends '.gz' to the file name)
+        if compress:
+            file_name += '.gz'
+            f = gzip.GzipFile(file_name, 'wb', compresslevel=6)
+        else:
+            f = open(file_name, 'w')
+        f.write(text)
+        f.close()
+        return file_name
+
+    def format_bed_graph(self, window_size, name, label):
+        """
+        :return: text of the bedGraph file of a track
+        """
+        track = self.__get_tracks([name])[0]
+        # write header
+        chunks = ['track type=bedGraph name="' + track['title'] + ' ' + label + '"\n']
+        for chro in self.chrs:
+            starts, ends = self.__get_windows(window_size, chro)
+            prefix = 'chr' + chro + '\t'
+            # format: chrom chromStart chromEnd dataValue
+            lines = [prefix + start + '\t' + end + '\t' + value for start, end, value in
+                     zip(map(str, starts.tolist()), map(str, ends.tolist()), self.iter_values(window_size, chro, name))]
+            if lines:
+                chunks.append('\n'.join(lines) + '\n')
+        return ''.join(chunks)
+
+    def format_wig(self, window_size, name, label):
+        """
+        :return: text of the wig file (fixedStep) of a track
+        """
+        track = self.__get_tracks([name])[0]
+        chunks = []
+        for chro in self.chrs:
+            # write header
+            chunks.append('track type=wiggle_0 name="' + track['title'] + ' ' + label + '"\n')
+            chunks.append('fixedStep chrom=chr%s start=0 step=%i span=%i\n' % (chro, int(window_size),
+                                                                                 int(window_size)))
+            values = list(self.iter_values(window_size, chro, name))
+            if values:
+                chunks.append('\n'.join(values) + '\n')
+        return ''.join(chunks)
+
+    def write_bed_graph(self, base_file_path, window_size, label, names=None, compress=False):
+        """
+        Write a bedGraph file for each track ('<base_file_path>_<name>.bed')
+        :param label: window size label written in the track headers
+        :param names: list of track names, None for all the tracks
+        :param compress: write gzip files ('.bed.gz')
+        :return: list of written files
+        """
+        return [self.__write_text(base_file_path + '_' + track['name'] + '.bed',
+                                  self.format_bed_graph(window_size, track['name'], label), compress)
+                for track in self.__get_tracks(names)]
+
+    def write_wig(self, base_file_path, window_size, label, names=None, compress=False):
+        """
+        Write a wig file (fixedStep) for each track ('<base_file_path>_<name>.wig')
+        :param label: window size label written in the track headers
+        :param names: list of track names, None for all the tracks
+        :param compress: write gzip files ('.wig.gz')
+        :return: list of written files
+        """
+        return [self.__write_text(base_file_path + '_' + track['name'] + '.wig',
+                                  self.format_wig(window_size, track['name'], label), compress)
+                for track in self.__get_tracks(names)]
+
+    def write_big_wig(self, base_file_path, window_size, names=None):
+        """
+        Write a bigWig file for each track ('<base_file_path>_<name>.bw') with the windows of the chromosomes
+        :param names: list of track names, None for all the tracks
+        :return: list of written files
+        """
+        file_names = []
+        chr_sizes = {'chr' + chro: self.chr_sizes[chro] for chro in self.chrs}
+        for track in self.__get_tracks(names):
+            file_name = base_file_path + '_' + track['name'] + '.bw'
+            writer = BigWigWriter(file_name, chr_sizes)
+            for chro in self.chrs:
+                values, counts = self.get_track(window_size, chro, track['name'])
+                starts, ends = self.__get_windows(window_size, chro)
+                writer.add_intervals('chr' + chro, starts, ends, values)
+            writer.close()
+            file_names.append(file_name)
+        return file_names
@@ -1,12 +1,18 @@
 import os
 import re
 import sys
+import time
 import datetime
 import itertools
 import json
+import argparse
 from classes.ensembl_client import EnsemblRestClient
+from classes.ensembl_cache import EnsemblCache
 from classes.gene_database import GeneDatabase
 from classes.enrichr import EnrichR
+from classes.region_index import RegionIndex
+from classes.fisher_exact import FisherExact
+from classes.parallel import run_jobs
 import numpy as np
 import scipy.stats as stats
 from statsmodels.sandbox.stats.multicomp import multipletests
@@ -14,6 +20,10 @@ from scripts.similarity_matrix_graph import generate_similarity_graph
 
 VALID_CHRs = [str(i) for i in range(1, 23)] + ['X', 'Y']
 WSIZES = [500000.0, 250000.0, 100000.0, 50000.0, 20000.0]
+ENSEMBL_CACHE_FILE = 'ensembl_variation_cache.db'  # sqlite cache of ensembl REST responses
+
+# batched fisher test shared by all the enrichr tests (and inherited by the workers), keeps its log-factorial cache
+__fisher_exact = FisherExact()
 
 
 def load_lines(file_name):
@@ -46,23 +56,21 @@ def get_regions_from_ensembl_snps(snps):
     return regions
 
 
-def __is_in_region(region, chr, start, end, wsize):
-    # checks whether a feature located at chr:start-end overlaps a region
-    dist = wsize / 2
-    positions = region.get(chr, [])
-    for pos_obj in positions:
-        pos = pos_obj['pos'] if type(pos_obj) is dict else pos_obj
-        if abs(pos - start) < dist or abs(pos - end) < dist:
-            return pos_obj
-    return None
+def create_region_index(region, wsize):
+    # build an index of the region windows, reuse it for every query with the same (region, wsize)
+    if isinstance(region, RegionIndex):
+        assert region.wsize == wsize
+        return region
+    return RegionIndex(region, wsize)
 
 
 def count_genes_in_region(genes, genes_db, region, wsize, add_to_list=None):
-    # count genes in list that overlaps a region
+    # count genes in list that overlaps a region (dict or RegionIndex)
+    region_index = create_region_index(region, wsize)
     count = 0
     for gene_id in genes:
         gene_data = genes_db.get_by_id(gene_id)
-        if __is_in_region(region, gene_data.chr, gene_data.start, gene_data.end, wsize) is not None:
+        if region_index.overlaps(gene_data.chr, gene_data.start, gene_data.end):
             count += 1
             if type(add_to_list) is list:
                 add_to_list.append(gene_data)
@@ -71,8 +79,9 @@ def count_genes_in_region(genes, genes_db, region, wsize, add_to_list=None):
 
 def associate_genes_with_region(genes_data, region, wsize):
     assoc = {chr: [{'chr': chr, 'pos': pos, 'genes': set([])} for pos in region[chr]] for chr in region.keys()}
+    assoc_index = create_region_index(assoc, wsize)
     for gene_data in genes_data:
-        pos_obj = __is_in_region(assoc, gene_data.chr, gene_data.start, gene_data.end, wsize)
+        pos_obj = assoc_index.find(gene_data.chr, gene_data.start, gene_data.end)
         if pos_obj is not None:
             pos_obj['genes'].add(gene_data)
         else:
@@ -104,17 +113,21 @@ def calc_regions_by_gene_count(assoc):
     return map(lambda n: (n, counts[n]), sorted(counts.keys()))
 
 
-def create_snp_regions(snps_ids):
-    # build snps regions using ensembl REST API
-    client = EnsemblRestClient()
-    snps = client.get_snps(snps_ids)
+def create_snp_regions(snps_ids, cache_file=None, offline=False, checkpoint_file=None):
+    # build snps regions using ensembl REST API, responses are cached in cache_file (sqlite) if given and completed
+    # requests are recorded in checkpoint_file (if given) to resume an interrupted run
+    cache = EnsemblCache(cache_file) if cache_file is not None else None
+    client = EnsemblRestClient(cache=cache, offline=offline)
+    snps = client.get_snps(snps_ids, checkpoint_file=checkpoint_file)
+    if cache is not None:
+        cache.close()
     return get_regions_from_ensembl_snps(snps)
 
 
-def create_gene_db(taxonomy_id, mart_file):
-    # create a gene DB using an ensembl mart export
+def create_gene_db(taxonomy_id, mart_file, snapshot_dir=None):
+    # create a gene DB using an ensembl mart export, saved in a binary snapshot if snapshot_dir is given
     genes_db = GeneDatabase(taxonomy_id)
-    genes_db.load_mart_export(mart_file)
+    genes_db.load_mart_export(mart_file, snapshot_dir=snapshot_dir)
     return genes_db
 
 
@@ -123,18 +136,33 @@ def calc_genes_in_region_table(region, genes_db, gene_ids, wsize):
     Calculates 2x2 table of gene counts: [[b1, n1], [b2, n2]]
     b1: number of selected genes that match a region, n1: total of selected genes
     b2: number of background genes that match a region, n2: total of background genes
-    :param region: dict of {chr: [p1, p2, ...]} as returned by 'get_regions_from_ensembl_snps'
+    :param region: dict of {chr: [p1, p2, ...]} as returned by 'get_regions_from_ensembl_snps' or its RegionIndex
     :param genes_db:
     :param gene_ids: list of selected genes (for example: diff expressed in a GEO study)
     :param wsize: window size used to calculate region match (centered in a region)
     :return: a tuple with the contingency table (2x2) and matching genes array
     """
-    control_gene_ids = genes_db.get_difference(gene_ids)
-    matching_genes = []
-    b1 = count_genes_in_region(gene_ids, genes_db, region, wsize, add_to_list=matching_genes)
-    n1 = len(gene_ids)
-    b2 = count_genes_in_region(control_gene_ids, genes_db, region, wsize)
-    n2 = len(control_gene_ids)
+    gene_idxs = filter(lambda idx: idx is not None, map(genes_db.get_index, gene_ids))
+    return calc_gene_indices_in_region_table(region, genes_db, gene_idxs, wsize, num_selected=len(gene_ids))
+
+
+def calc_gene_indices_in_region_table(region, genes_db, gene_idxs, wsize, num_selected=None):
+    """
+    As 'calc_genes_in_region_table' for selected genes given as gene indices of genes_db
+    :param gene_idxs: list or array of gene indices
+    :param num_selected: n1 of the table, defaults to the number of gene indices
+    :return: a tuple with the contingency table (2x2) and matching genes array
+    """
+    region = create_region_index(region, wsize)
+    region_genes = region.get_gene_hits(genes_db)  # computed once per (region, wsize)
+    matching_genes = [genes_db.get_gene(idx) for idx in gene_idxs if region_genes[idx]]
+    b1 = len(matching_genes)
+    n1 = len(gene_idxs) if num_selected is None else num_selected
+
+    # background genes are the genes of the database not selected
+    selected = np.unique(np.asarray(gene_idxs, dtype=np.int64))
+    b2 = region.get_num_gene_hits(genes_db) - int(np.count_nonzero(region_genes[selected]))
+    n2 = genes_db.get_num_genes() - len(selected)
     table = [[b1, n1], [b2, n2]]
     return table, matching_genes
 
@@ -170,13 +198,15 @@ def test1():
     print 'oddsratio: %f, pvalue: %f' % (oddsratio, pvalue)
 
 
-def test_genes_vs_multiple_snps(gene_ids, input_path, output_path):
+def test_genes_vs_multiple_snps(gene_ids, input_path, output_path, offline=False, checkpoint_file=None,
+                                gene_snapshot_dir=None):
     file_pattern = '(.+)\.txt'
     ll_ids_pattern = '"([\w\s;]+)"'
     prog = re.compile(file_pattern)
     ll_prog = re.compile(ll_ids_pattern)
 
-    genes_db = create_gene_db('9606', os.path.join(input_path, 'GRCh38/mart_export.txt.gz'))
+    genes_db = create_gene_db('9606', os.path.join(input_path, 'GRCh38/mart_export.txt.gz'),
+                              snapshot_dir=gene_snapshot_dir)
 
     snp_files = [f for f in os.listdir(input_path) if os.path.isfile(os.path.join(input_path, f)) and prog.match(f)]
     wsizes = WSIZES
@@ -187,14 +217,17 @@ def test_genes_vs_multiple_snps(gene_ids, input_path, output_path):
         good_ids = filter(lambda i: i.startswith('rs'), snps_ids)
         ld_ids = filter(lambda i: ll_prog.match(i), snps_ids)
         ld_ids = map(lambda i: ll_prog.match(i).groups()[0].split(';')[0], ld_ids)
-        regions = create_snp_regions(good_ids + ld_ids)
+        regions = create_snp_regions(good_ids + ld_ids, cache_file=os.path.join(input_path, ENSEMBL_CACHE_FILE),
+                                     offline=offline,
+                                     checkpoint_file=checkpoint_file + '.' + disease if checkpoint_file else None)
 
         print '\n===== Test for disease: %s =====' % disease
 
         for wsize in wsizes:
             wsize_str = human_format(wsize)
             print '--- Window size = %s ---' % wsize_str
-            table, match_genes = calc_genes_in_region_table(regions.get('GRCh38'), genes_db, gene_ids, wsize)
+            region_index = create_region_index(regions.get('GRCh38'), wsize)
+            table, match_genes = calc_genes_in_region_table(region_index, genes_db, gene_ids, wsize)
             oddsratio, pvalue = stats.fisher_exact(table)
             assoc = associate_genes_with_region(match_genes, regions.get('GRCh38'), wsize)
             regions_by_gene_count = calc_regions_by_gene_count(assoc)
@@ -215,40 +248,28 @@ def enrichr_db_test(file_name, region, genes_db, wsize, pvalue_thr=0.05, record_
     """
     Runs, for each record of a 'enrich_db table', a fisher test using 'calc_genes_in_region_table' contingency table
     :param file_name: full path to enrich_db table
-    :param region: dict of {chr: [p1, p2, ...]} as returned by 'get_regions_from_ensembl_snps'
+    :param region: dict of {chr: [p1, p2, ...]} as returned by 'get_regions_from_ensembl_snps' or its RegionIndex
     :param genes_db:
     :param wsize: window size used to calculate region match (centered in a region)
     :param pvalue_thr: pvalue threshold for FDR
     :param record_filter: lambda function for record filtering
     :return: a list of tuples (lib_name, record, b1, n1, b2, n2, oddsratio, pval, corr_pval, matching_genes)
     """
-    data_lib = EnrichR.load_library(file_name)
+    # records with their genes already resolved to gene indices
+    data_lib = EnrichR.load_resolved_library(file_name, genes_db, record_filter=record_filter)
     lib_name = os.path.basename(file_name[:-7])  # remove '.txt.gz'
-    results = []
-
-    if record_filter is not None:
-        selected_records = filter(lambda r: record_filter(r), data_lib.keys())
-    else:
-        selected_records = data_lib.keys()
-
-    for record in selected_records:
-        # extract genes highlighted by the study
-        gene_names = EnrichR.extract_gene_list(data_lib, record)
-        gene_ids = []
-
-        for name in gene_names:
-            # translate gene names to gene_id (ensembl ids)
-            gene = genes_db.get_by_name(name)
-            if gene:
-                gene_ids.append(gene.id)
-            else:
-                pass  # gene name not found
+    region = create_region_index(region, wsize)
+    tables = []
 
+    for record, gene_idxs in data_lib.iteritems():
         # calculate contingency table for the genes in the study
-        t, match_genes = calc_genes_in_region_table(region, genes_db, gene_ids, wsize)
-        oddsratio, pvalue = stats.fisher_exact(t)
+        t, match_genes = calc_gene_indices_in_region_table(region, genes_db, gene_idxs, wsize)
+        tables.append((lib_name, record, t[0][0], t[0][1], t[1][0], t[1][1], match_genes))
 
-        results.append((lib_name, record, t[0][0], t[0][1], t[1][0], t[1][1], oddsratio, pvalue, match_genes))
+    # run the fisher test of all the contingency tables at once
+    b1, n1, b2, n2 = [[t[k] for t in tables] for k in range(2, 6)]
+    oddsratios, pvalues = __fisher_exact.test(b1, n1, b2, n2)
+    results = [res[:6] + (oddsratios[i], pvalues[i], res[6]) for i, res in enumerate(tables)]
 
     # multiple test correction using FDR
     pvals = map(lambda r: r[7], results)
@@ -264,6 +285,51 @@ def enrichr_db_test(file_name, region, genes_db, wsize, pvalue_thr=0.05, record_
     return results_corr
 
 
+def __run_scan_job(state, job):
+    # runs a (library file, window size) job of 'enrichr_scan'
+    lib_file, wsize = job
+    start = time.time()
+    res = enrichr_db_test(lib_file, state['region_indexes'][wsize], state['genes_db'], wsize,
+                          pvalue_thr=state['pvalue_thr'], record_filter=state['record_filter'])
+    return job, res, time.time() - start
+
+
+def enrichr_scan(lib_files, region, genes_db, wsizes, jobs=1, pvalue_thr=0.05, record_filter=None):
+    """
+    Runs 'enrichr_db_test' for every (library, window size) pair. Jobs are distributed over a pool of worker
+    processes, the gene database and the region indexes are shared with the workers through fork.
+    :param lib_files: list of full paths to enrich_db tables
+    :param region: dict of {chr: [p1, p2, ...]} as returned by 'get_regions_from_ensembl_snps'
+    :param genes_db:
+    :param wsizes: list of window sizes
+    :param jobs: number of worker processes
+    :param pvalue_thr: pvalue threshold for FDR
+    :param record_filter: lambda function for record filtering
+    :return: dict of {wsize: [(lib_name, results), ...]} sorted by library name, see 'enrichr_db_test' results
+    """
+    region_indexes = {}
+    for wsize in wsizes:
+        region_indexes[wsize] = create_region_index(region, wsize)
+        region_indexes[wsize].get_gene_hits(genes_db)  # fill the cache before forking
+
+    state = {'region_indexes': region_indexes, 'genes_db': genes_db, 'pvalue_thr': pvalue_thr,
+             'record_filter': record_filter}
+
+    # the jobs of a library are sent together to the same worker, that resolves the library once (cached)
+    scan_jobs = [(lib_file, wsize) for lib_file in sorted(lib_files) for wsize in wsizes]
+    results = {}
+
+    for job, res, elapsed in run_jobs(__run_scan_job, scan_jobs, jobs=jobs, shared=state, chunksize=len(wsizes)):
+        lib_name = os.path.basename(job[0][:-7])  # remove '.txt.gz'
+        print '%i matches in %s (wsize=%s), %.1fs [%s]' % (len(res), lib_name, human_format(job[1]), elapsed,
+                                                          datetime.datetime.now().isoformat())
+        results[job] = res
+
+    # sort results by window size and library name
+    return {wsize: [(os.path.basename(lib_file[:-7]), results[(lib_file, wsize)]) for lib_file in sorted(lib_files)]
+            for wsize in wsizes}
+
+
 def __result_similarity(gene_res_1, gene_res_2):
     set1 = set(gene_res_1)
     set2 = set(gene_res_2)
@@ -333,40 +399,55 @@ def __write_genes_vs_regions_table(out_file, regions_by_gene_count):
 
 
 if __name__ == "__main__":
-    base_path = '/home/victor/Escritorio/Genotipado_Alternativo/colocalizacion'
+    parser = argparse.ArgumentParser(description='Colocalization of genes and SNP regions')
+    parser.add_argument('--mode', choices=['diseases', 'scan'], default='diseases',
+                        help='diseases: genes vs the snps of each disease, scan: enrichr scan of the MS snps')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes for the enrichr scan')
+    parser.add_argument('--offline', action='store_true', help='read ensembl SNPs from cache only (no network)')
+    parser.add_argument('--checkpoint', default=None,
+                        help='checkpoint file of the ensembl SNP requests, an interrupted run is resumed from it '
+                             '(in diseases mode a file per disease is created with the disease as suffix)')
+    parser.add_argument('--gene-snapshot', default=None,
+                        help='directory of a binary snapshot of the mart export, loaded instead of parsing it')
+    parser.add_argument('--base-path', default='/home/victor/Escritorio/Genotipado_Alternativo/colocalizacion',
+                        help='directory of the input files, outputs are written there')
+    args = parser.parse_args()
+
+    base_path = args.base_path
 
     # test1()
-    test_genes_vs_multiple_snps(load_lines(os.path.join(base_path, 'sp140_genes.txt')),
-                                os.path.join(base_path, 'snps_diseases'),
-                                os.path.join(base_path, 'snps_diseases/output'))
-    sys.exit(0)
+    if args.mode == 'diseases':
+        test_genes_vs_multiple_snps(load_lines(os.path.join(base_path, 'sp140_genes.txt')),
+                                    os.path.join(base_path, 'snps_diseases'),
+                                    os.path.join(base_path, 'snps_diseases/output'), offline=args.offline,
+                                    checkpoint_file=args.checkpoint, gene_snapshot_dir=args.gene_snapshot)
+        sys.exit(0)
 
     print 'Started:', datetime.datetime.now().isoformat()
 
     snps_ids = load_lines(os.path.join(base_path, 'MS.txt'))
-    regions = create_snp_regions(snps_ids)
-    genes_db = create_gene_db('9606', os.path.join(base_path, 'GRCh38/mart_export.txt.gz'))
+    regions = create_snp_regions(snps_ids, cache_file=os.path.join(base_path, ENSEMBL_CACHE_FILE),
+                                 offline=args.offline, checkpoint_file=args.checkpoint)
+    genes_db = create_gene_db('9606', os.path.join(base_path, 'GRCh38/mart_export.txt.gz'),
+                              snapshot_dir=args.gene_snapshot)
 
     enrichr_path = os.path.join(base_path, 'enrichr')
     lib_files = EnrichR.list_libraries(enrichr_path)
     lib_files = filter(lambda n: n.startswith('Single_Gene_Perturbations_from_GEO'), lib_files)
-    lib_files = sorted(lib_files)
+    lib_files = map(lambda n: os.path.join(enrichr_path, n), lib_files)
     wsizes = WSIZES
     # wsizes = [500000.0]
     record_filter = lambda r: r.find('GSE50588') > -1
 
+    scan_results = enrichr_scan(lib_files, regions.get('GRCh38'), genes_db, wsizes, jobs=args.jobs,
+                                record_filter=record_filter)
+
     for wsize in wsizes:
         wsize_str = human_format(wsize)
-        lib_results = {}
         genes_in_regions = []
         results_all = []
 
-        for name in lib_files:  # Note: lib_files is sorted
-            lib_name = name[:-7]  # remove '.txt.gz'
-            res = enrichr_db_test(os.path.join(enrichr_path, name), regions.get('GRCh38'), genes_db, wsize,
-                                  record_filter=record_filter)
-            print '%i matches in %s, [%s]' % (len(res), lib_name, datetime.datetime.now().isoformat())
-            lib_results[lib_name] = res
+        for lib_name, res in scan_results[wsize]:  # Note: results are sorted by library name
             results_all += res
             genes_in_regions += list(itertools.chain.from_iterable(map(lambda r: r[9], res)))
 
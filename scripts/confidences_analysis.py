@@ -1,11 +1,16 @@
 import os
+import time
 import datetime
-import gzip
+import argparse
 from classes.snp_database import SnpDatabase
+from classes.input_reader import InputReader
+from classes.parallel import run_jobs
 from scipy import stats
 import numpy as np
 import matplotlib.pyplot as plt
 
+THRESHOLD_BLOCK_ROWS = 4096  # probes sorted at once by calc_missing_threshold
+
 
 def load_missing_stats(path):
     stats = {}
@@ -20,47 +25,96 @@ def load_missing_stats(path):
     return stats
 
 
-def load_oligo_confidences(path):
+def load_oligo_confidences(path, probe_ids=None):
+    """
+    Load the oligo (crlmm) confidences file
+    :param path:
+    :param probe_ids: None or collection of probe ids to load (e.g. SnpDatabase.get_probe_ids(chr)), the file is
+    read until all of them are found. If a probe id is repeated in the file its first row is kept, while the last
+    row is kept when probe_ids is None.
+    :return: dict with keys 'subjects', 'matrix' (probes x subjects array of confidences), 'probe_index' (probe id
+    to matrix row) and 'confidences' (probe id to its matrix row)
+    """
     sep_char = ' '
-    f = gzip.open(path, 'r')
+    pending = set(probe_ids) if probe_ids is not None else None  # probe ids not found yet
+    probe_index = {}  # dict with key=probe_id and value=row
+    rows = []  # list of confidences of each row
 
-    header = f.readline()
-    subjects = map(lambda s: os.path.splitext(os.path.basename(s[1:-1]))[0], header.split(sep_char))
+    with InputReader(path) as f:
+        header = f.readline()
+        subjects = map(lambda s: os.path.splitext(os.path.basename(s[1:-1]))[0], header.split(sep_char))
 
-    confidences = {}  # dict with key=probe_id and value=list of confidences
-    for line in f:
-        toks = line.split(sep_char)
-        confidences[toks[0][1:-1]] = map(lambda i: float(toks[i]), range(1, len(toks)))
+        for line_num, line in enumerate(f, 2):
+            if pending is not None:
+                probe_id = line[:line.find(sep_char)][1:-1]
+                if probe_id not in pending:
+                    continue  # not wanted (or already read), skip tokenizing
+                pending.discard(probe_id)
 
-    f.close()
-    return {'subjects': subjects, 'confidences': confidences}
+            toks = line.split(sep_char)
+            if len(toks) - 1 != len(subjects):
+                raise ValueError('Bad confidences row for %s in %s (line %i): %i values for %i subjects' % (
+                    toks[0][1:-1], path, line_num, len(toks) - 1, len(subjects)))
+            probe_index[toks[0][1:-1]] = len(rows)
+            rows.append(map(lambda i: float(toks[i]), range(1, len(toks))))
+
+            if pending is not None and not pending:
+                break
+
+    matrix = np.array(rows, dtype=np.float64).reshape((len(rows), len(subjects)))
+    confidences = {probe_id: matrix[row] for probe_id, row in probe_index.iteritems()}
+    return {'subjects': subjects, 'matrix': matrix, 'probe_index': probe_index, 'confidences': confidences}
 
 
 def calc_missing_threshold(chro, snp_db, oligo_confs):
+    """
+    For each probe of a chromosome with missing info (lmiss) and confidences, gets the N_MISS-th lowest confidence
+    and its zscore, computed for all the probes at once on blocks of rows of the confidences matrix.
+    :return: dict of probe_id to (threshold, zscore), (-1, -1) for probes without missing
+    """
     probe_ids = snp_db.get_probe_ids(chro)
-    confs = oligo_confs['confidences']
-    snp_thresholds = {}
-
+    probe_index = oligo_confs['probe_index']
+    matrix = oligo_confs['matrix']
+    table = snp_db.get_chr_table(chro)
+    n_miss, has_lmiss = table.get_values('lmiss.N_MISS')
+
+    # probes with confidences and missing info
+    selected = []
+    conf_rows = []
+    positions = []
     for probe_id in probe_ids:
         rs_id = snp_db.get_rs_id(chro, probe_id)
-        values = confs.get(probe_id)
-        lmiss_data = None
-
-        if rs_id is not None:
-            lmiss_data = snp_db.get_snp_data(chro, rs_id).get('lmiss')
+        conf_row = probe_index.get(probe_id)
+        row = table.get_row(rs_id) if rs_id is not None else None
 
-        if values is None or rs_id is None or lmiss_data is None:
+        if conf_row is None or row is None or not has_lmiss[row]:
             continue
 
-        pos = lmiss_data['N_MISS'] - 1
-        threshold = None
+        selected.append(probe_id)
+        conf_rows.append(conf_row)
+        positions.append(n_miss[row] - 1)
+
+    conf_rows = np.array(conf_rows, dtype=np.int64)
+    positions = np.array(positions, dtype=np.int64)
+    thresholds = np.zeros(len(selected), dtype=np.float64)
+    zscores = np.zeros(len(selected), dtype=np.float64)
+    with_missing = np.flatnonzero(positions >= 0)
+
+    for start in range(0, len(with_missing), THRESHOLD_BLOCK_ROWS):
+        block = with_missing[start:start + THRESHOLD_BLOCK_ROWS]
+        # rows are sorted so mean and std are computed as in stats.zscore over the sorted confidences
+        values = np.sort(matrix[conf_rows[block]], axis=1)
+        block_pos = positions[block]
+        thresholds[block] = values[np.arange(len(block)), block_pos]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zscores[block] = (thresholds[block] - values.mean(axis=1)) / values.std(axis=1)
 
-        if pos >= 0:
-            values = sorted(values)
-            zscores = stats.zscore(np.array(values))
-            threshold = (values[pos], zscores[pos])
-
-        snp_thresholds[probe_id] = threshold if threshold is not None else (-1, -1)
+    snp_thresholds = {}
+    for i, probe_id in enumerate(selected):
+        if positions[i] >= 0:
+            snp_thresholds[probe_id] = (thresholds[i].item(), zscores[i])
+        else:
+            snp_thresholds[probe_id] = (-1, -1)
 
     return snp_thresholds
 
@@ -77,6 +131,55 @@ def write_threshold_result(out_dir, chro, snp_thresholds, snp_db):
     f.close()
 
 
+def __run_threshold_job(state, chro):
+    # runs the missing threshold analysis of a chromosome for 'genome_wide_missing_threshold'
+    start = time.time()
+    snp_thresholds = calc_missing_threshold(chro, state['snp_db'], state['oligo_confs'])
+    write_threshold_result(state['out_dir'], chro, snp_thresholds, state['snp_db'])
+    return chro, len(snp_thresholds), time.time() - start
+
+
+def genome_wide_missing_threshold(snp_db, oligo_confs, out_dir, chrs=None, jobs=1):
+    """
+    Runs 'calc_missing_threshold' and 'write_threshold_result' for several chromosomes in a pool of worker
+    processes, the snp database and the confidences matrix are shared read only with the workers through fork.
+    Writes a merged table of all the chromosomes (snp_thresholds_genome.txt) and the runtime of each chromosome
+    (snp_thresholds_runtime.txt).
+    :param snp_db: SnpDatabase with the birdseed snps and missing info of the chromosomes
+    :param oligo_confs: confidences loaded by 'load_oligo_confidences'
+    :param out_dir:
+    :param chrs: list of chromosomes, None for chromosomes 1 to 22
+    :param jobs: number of worker processes
+    :return: dict of chr to (number of probes, seconds)
+    """
+    chrs = [str(i) for i in range(1, 23)] if chrs is None else chrs
+    state = {'snp_db': snp_db, 'oligo_confs': oligo_confs, 'out_dir': out_dir}
+
+    runtimes = {}
+    for chro, num_probes, elapsed in run_jobs(__run_threshold_job, chrs, jobs=jobs, shared=state):
+        print 'Chr %s: %i probes in %.2f s' % (chro, num_probes, elapsed)
+        runtimes[chro] = (num_probes, elapsed)
+
+    # merge the per chromosome tables
+    f = open(os.path.join(out_dir, 'snp_thresholds_genome.txt'), 'w')
+    f.write('chro\tprobe_id\tsnp_id\tthreshold\tnorm_thr\tf_miss\n')
+    for chro in chrs:
+        f_chr = open(os.path.join(out_dir, 'snp_thresholds_chr%s.txt' % chro), 'r')
+        f_chr.readline()  # skip header
+        for line in f_chr:
+            f.write(line)
+        f_chr.close()
+    f.close()
+
+    f = open(os.path.join(out_dir, 'snp_thresholds_runtime.txt'), 'w')
+    f.write('chro\tnum_probes\tseconds\n')
+    for chro in chrs:
+        f.write('%s\t%i\t%.3f\n' % (chro, runtimes[chro][0], runtimes[chro][1]))
+    f.close()
+
+    return runtimes
+
+
 def violin_plot(data_missing, data_no_missing):
     fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(12, 5))
 
@@ -140,16 +243,18 @@ def oligo_vs_birdseed_missing_threshold_cmp():
     birdseed_base = '/home/victor/Escritorio/matesanz2015'
     crlmm_base = '/home/victor/Escritorio/Genotipado_Alternativo/data'
 
+    chro = '1'
+
+    # only the analysed chromosome is loaded
     db = SnpDatabase()
-    db.load_from_birdseed(birdseed_base, '8090939')
-    db.load_missing_info(os.path.join(birdseed_base, 'missing_output'))
+    db.load_from_birdseed(birdseed_base, '8090939', chrs=[chro])
+    db.load_missing_info(os.path.join(birdseed_base, 'missing_output'), chrs=[chro])
 
     target_missing_stats = load_missing_stats(os.path.join(birdseed_base, 'missing_output/missing_stats.txt'))
 
     confs_file = os.path.join(crlmm_base, 'crlmm_out/confs.txt.gz')
-    confidences = load_oligo_confidences(confs_file)
+    confidences = load_oligo_confidences(confs_file, probe_ids=db.get_probe_ids(chro))
 
-    chro = '1'
     snp_thresholds = calc_missing_threshold(chro, db, confidences)
     write_threshold_result(crlmm_base, chro, snp_thresholds, db)
 
@@ -169,7 +274,32 @@ def oligo_vs_birdseed_missing_threshold_cmp():
     plot_fmiss_vs_threshold(chro, snp_thresholds, db)
 
 
+def oligo_vs_birdseed_missing_threshold_genome(jobs=1):
+    birdseed_base = '/home/victor/Escritorio/matesanz2015'
+    crlmm_base = '/home/victor/Escritorio/Genotipado_Alternativo/data'
+
+    db = SnpDatabase()
+    db.load_from_birdseed(birdseed_base, '8090939', jobs=jobs)
+    db.load_missing_info(os.path.join(birdseed_base, 'missing_output'))
+
+    confs_file = os.path.join(crlmm_base, 'crlmm_out/confs.txt.gz')
+    probe_ids = set([])
+    for chro in db.probe_id_map:
+        probe_ids.update(db.get_probe_ids(chro))
+    confidences = load_oligo_confidences(confs_file, probe_ids=probe_ids)
+
+    genome_wide_missing_threshold(db, confidences, crlmm_base, jobs=jobs)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Oligo confidences vs birdseed missing analysis')
+    parser.add_argument('--genome-wide', action='store_true', help='threshold analysis of chromosomes 1 to 22')
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes')
+    args = parser.parse_args()
+
     print 'Started:', datetime.datetime.now().isoformat()
-    oligo_vs_birdseed_missing_threshold_cmp()
+    if args.genome_wide:
+        oligo_vs_birdseed_missing_threshold_genome(jobs=args.jobs)
+    else:
+        oligo_vs_birdseed_missing_threshold_cmp()
     print 'Finished:', datetime.datetime.now().isoformat()
@@ -2,16 +2,23 @@ import os
 import datetime
 import re
 import sys
-import subprocess
+import multiprocessing
+import numpy as np
 
 from classes.snp_database import SnpDatabase
 from classes.tfam import Tfam
+from classes.plink_bed import PlinkBed
+from classes.track_builder import TrackBuilder
+from classes.parallel import run_jobs
 
 # constants
 PED_FILE_NAME_REGEX = '_(\d+)'
 MISSING_CHAR = '?'  # char code for missing
 WINDOW_SIZES = [1e6, 500000.0, 250000.0, 100000.0, 50000.0, 20000.0, 10000.0]
 HG38_POS = 'hg38_pos'  # hg38 position field
+# missing tracks: (name, field, title)
+MISSING_TRACKS = [('parents', 'lmiss.missing_par', 'Missing parents'),
+                  ('children', 'lmiss.missing_child', 'Missing children')]
 
 hg38_CHR_SIZES = {
     '1': 248956422,
@@ -65,9 +72,30 @@ def load_gwas_snps(path):
     return gwas_snps
 
 
+def read_ped_missing(line, num_snps):
+    """
+    Parse a PED line and flag the snps with missing genotype (first allele equal to MISSING_CHAR)
+    :param line:
+    :param num_snps:
+    :return: a tuple (list of the 6 fam fields, boolean array of missing snps)
+    """
+    toks = line.split('\t', 6)
+    geno = np.frombuffer(toks[6], dtype=np.uint8) if len(toks) > 6 else np.zeros(0, dtype=np.uint8)
+
+    if len(geno) >= 4 * num_snps - 1 and (geno[1:4 * num_snps - 1:2] == ord('\t')).all():
+        # fast path: single char alleles, first allele of snp i is at byte 4 * i
+        return toks[:6], geno[0:4 * num_snps:4] == ord(MISSING_CHAR)
+
+    alleles = toks[6].split('\t')[0:2 * num_snps:2]
+    if len(alleles) < num_snps:
+        raise IndexError('ped line with %i snps, %i expected' % (len(alleles), num_snps))
+    return toks[:6], np.array(alleles) == MISSING_CHAR
+
+
 def load_missing_info_from_ped(path, gwas_snps, tfam):
     """
-    Count amount of missing in ped files
+    Count amount of missing in ped files, each line is parsed to an array of missing flags that is added to the
+    counts of its group (parents or children)
     :param path: 
     :param gwas_snps: 
     :param tfam: 
@@ -80,20 +108,53 @@ def load_missing_info_from_ped(path, gwas_snps, tfam):
     for ped_file in ped_files:
         chro = p.match(ped_file).groups()[0]
         chro_snps = gwas_snps[chro]
+        counts = {'missing_par': np.zeros(len(chro_snps), dtype=np.int64),
+                  'missing_child': np.zeros(len(chro_snps), dtype=np.int64)}
 
         f = open(os.path.join(path, ped_file), 'r')
         for line in f:
-            toks = line.split('\t')
-            subject = tfam.get_subject_from_fam(toks)
+            fam, missing = read_ped_missing(line, len(chro_snps))
+            subject = tfam.get_subject_from_fam(fam)
             missing_count_field = 'missing_par' if tfam.is_parent(subject) else 'missing_child'
-
-            for i, snp in enumerate(chro_snps):
-                idx = 6 + i * 2
-                if toks[idx] == MISSING_CHAR:
-                    snp[missing_count_field] += 1
+            counts[missing_count_field] += missing
 
         f.close()
 
+        for missing_count_field in counts:
+            for snp, count in zip(chro_snps, counts[missing_count_field].tolist()):
+                snp[missing_count_field] += count
+
+
+def has_bed_files(path):
+    p = re.compile(PED_FILE_NAME_REGEX + '\.bed')
+    return len(filter(lambda name: p.match(name), os.listdir(path))) > 0
+
+
+def load_gwas_snps_from_bed(path, tfam):
+    """
+    Load GWAS snps and count amount of missing from plink binary filesets (.bed/.bim/.fam), missing genotypes are
+    counted on the packed .bed without decoding it
+    :param path:
+    :param tfam:
+    :return: a map with key=chr and values=list  (id, pos, missing_par, missing_child)
+    """
+    gwas_snps = {}
+
+    p = re.compile(PED_FILE_NAME_REGEX + '\.bed')
+    bed_files = filter(lambda name: p.match(name), os.listdir(path))
+
+    for bed_file in bed_files:
+        chro = p.match(bed_file).groups()[0]
+        bed = PlinkBed(os.path.join(path, bed_file[:-4]))
+        parents = np.array([tfam.is_parent(tfam.get_subject_from_fam(fam)) for fam in bed.fam], dtype=bool)
+        missing_par = bed.get_missing_counts(parents).tolist()
+        missing_child = bed.get_missing_counts(~parents).tolist()
+
+        gwas_snps[chro] = [{'id': snp[1], 'pos': int(snp[3]), 'missing_par': missing_par[i],
+                            'missing_child': missing_child[i]} for i, snp in enumerate(bed.snps)]
+
+    return gwas_snps
+
 
 def check_missing_with_plink_results(snp_db, gwas_snps):
     """
@@ -111,8 +172,8 @@ def check_missing_with_plink_results(snp_db, gwas_snps):
             assert data['lmiss']['N_MISS'] == (snp['missing_par'] + snp['missing_child'])
             count += 1
             # add extra info to snp_db
-            data['lmiss']['missing_par'] = snp['missing_par']
-            data['lmiss']['missing_child'] = snp['missing_child']
+            snp_db.set_snp_field(chro, snp['id'], 'lmiss.missing_par', snp['missing_par'])
+            snp_db.set_snp_field(chro, snp['id'], 'lmiss.missing_child', snp['missing_child'])
         print 'chr', chro, count, 'checked'
 
 
@@ -125,84 +186,72 @@ def human_format(num):
     return '%i%s' % (num, ['', 'K', 'M', 'G', 'T', 'P'][magnitude])
 
 
-def chr_missing_windows(chro, snp_db, window_size, pos_field):
-    chr_size = hg38_CHR_SIZES[chro]
-    num_windows = int(chr_size / window_size) + (1 if int(chr_size % window_size) > 0 else 0)
-    miss_fields = ['missing_par', 'missing_child']
-    bins = [{'missing_par': 0, 'missing_child': 0, 'count': 0} for i in range(0, num_windows)]
+def generate_missing_tracks(snp_db, pos_field, qc_tracks=None):
+    """
+    Builds the missing tracks (mean of missing parents/children) of chromosomes 1 to 22 for all the window sizes
+    :param snp_db:
+    :param pos_field:
+    :param qc_tracks: list of extra tracks built in the same pass, tuples (name, field, aggregation, q)
+    :return: a TrackBuilder with the tracks
+    """
+    chrs = [str(i) for i in range(1, 23)]  # valid chromosomes
+    tracks = TrackBuilder(hg38_CHR_SIZES, WINDOW_SIZES)
+    for name, field, title in MISSING_TRACKS:
+        tracks.add_track(name, field, title=title)
+    for name, field, aggregation, q in qc_tracks or []:
+        tracks.add_track(name, field, aggregation=aggregation, q=q)
+    tracks.build(snp_db, pos_field, chrs)
+    return tracks
 
-    for snp in snp_db.get_chr_data(chro):
-        position = snp.get(pos_field)
-        if position is None:
-            continue
-        bin_idx = int(position / window_size)
-        for f in miss_fields:
-            bins[bin_idx][f] += snp['lmiss'][f]
-        bins[bin_idx]['count'] += 1.0
 
-    for bin in bins:
-        # calculate mean on each bin
-        denom = bin['count']
-        if denom > 0:
-            for f in miss_fields:
-                bin[f] /= denom
-    return bins
+def write_bed_graph(tracks, base_file_path, wsize):
+    # gzip compressed in process
+    return tracks.write_bed_graph(base_file_path, wsize, human_format(wsize), compress=True)
 
 
-def generate_missing_tracks(snp_db, pos_field):
-    chrs = [str(i) for i in range(1, 23)]  # valid chromosomes
-    tracks = {human_format(wsize): {chro: chr_missing_windows(chro, snp_db, wsize, pos_field) for chro in chrs}
-              for wsize in WINDOW_SIZES}
-    return tracks
+def write_wig(tracks, base_file_path, wsize):
+    # gzip compressed in process
+    return tracks.write_wig(base_file_path, wsize, human_format(wsize), compress=True)
 
 
-def write_bed_graph(track, base_file_path, wsize):
-    chrs = [str(i) for i in range(1, 23)]  # valid chromosomes
-    miss_tracks = {'parents': 'missing_par', 'children': 'missing_child'}
-
-    for miss_track in miss_tracks:
-        miss_field = miss_tracks[miss_track]
-        file_name = base_file_path + '_' + miss_track + '.bed'
-        f = open(file_name, 'w')
-
-        # write header
-        f.write('track type=bedGraph name="Missing ' + miss_track + ' ' + human_format(wsize) + '"\n')
-
-        for chro in chrs:
-            bins = track[chro]
-            for i, bin in enumerate(bins):
-                min_pos = int(i * wsize)
-                max_pos = int(min_pos + wsize)
-                if max_pos >= hg38_CHR_SIZES[chro]:
-                    max_pos = hg38_CHR_SIZES[chro]
-                value = bin[miss_field]
-                # format: chrom chromStart chromEnd dataValue
-                f.write('chr' + chro + '\t' + str(min_pos) + '\t' + str(max_pos) + '\t' + str(value) + '\n')
-        f.close()
-        # gzip output file
-        subprocess.call(['gzip', '-f', file_name])
+def write_big_wig(tracks, base_file_path, wsize):
+    # bigWig files are compressed internally
+    return tracks.write_big_wig(base_file_path, wsize)
 
 
-def write_wig(track, base_file_path, wsize):
-    chrs = [str(i) for i in range(1, 23)]  # valid chromosomes
-    miss_tracks = {'parents': 'missing_par', 'children': 'missing_child'}
+TRACK_WRITERS = {'bed': 'write_bed_graph', 'wig': 'write_wig', 'bw': 'write_big_wig'}
 
-    for miss_track in miss_tracks:
-        miss_field = miss_tracks[miss_track]
-        file_name = base_file_path + '_' + miss_track + '.wig'
-        f = open(file_name, 'w')
 
-        for chro in chrs:
-            # write header
-            f.write('track type=wiggle_0 name="Missing ' + miss_track + ' ' + human_format(wsize) + '"\n')
-            f.write('fixedStep chrom=chr%s start=0 step=%i span=%i\n' % (chro, int(wsize), int(wsize)))
+def __run_write_job(state, task):
+    # writes a track of a window size in a file format for 'write_tracks'
+    file_format, wsize, name = task
+    tracks = state['tracks']
+    base_file_path = os.path.join(state['out_dir'], human_format(wsize))
+    if file_format == 'bw':
+        return tracks.write_big_wig(base_file_path, wsize, names=[name])
+    writer = getattr(tracks, TRACK_WRITERS[file_format])
+    return writer(base_file_path, wsize, human_format(wsize), names=[name], compress=True)
 
-            bins = track[chro]
-            for bin in bins:
-                f.write(str(bin[miss_field]) + '\n')
-        f.close()
-        # gzip output file
-        subprocess.call(['gzip', '-f', file_name])
+
+def write_tracks(tracks, out_dir, file_formats=('wig',), jobs=1):
+    """
+    Writes the tracks of all the window sizes ('<out_dir>/<window size>_<track name>.<ext>'), every track, window
+    size and file format is written by a job of a pool of worker processes that share the built tracks through fork.
+    Text files are formatted in memory and gzip compressed in process.
+    :param tracks: built TrackBuilder
+    :param out_dir:
+    :param file_formats: list of formats, keys of TRACK_WRITERS
+    :param jobs: number of worker processes
+    :return: list of written files
+    """
+    tasks = [(file_format, wsize, track['name']) for wsize in tracks.window_sizes
+             for track in tracks.tracks for file_format in file_formats]
+    state = {'tracks': tracks, 'out_dir': out_dir}
+
+    file_names = []
+    for job_file_names in run_jobs(__run_write_job, tasks, jobs=jobs, shared=state):
+        file_names.extend(job_file_names)
+    return file_names
 
 
 if __name__ == "__main__":
@@ -215,30 +264,31 @@ if __name__ == "__main__":
 
     # downloaded from: ftp://hgdownload.soe.ucsc.edu/goldenPath/hg38/database/snp147Common.txt.gz
     db_snp_hg38 = '/home/victor/Escritorio/Genotipado_Alternativo/data/dbSNP/snp147.txt.gz'
-    # cache of hg38 positions for IMSGC gwas snps
-    imsgc_gwas_positions = '/home/victor/Escritorio/Genotipado_Alternativo/data/dbSNP/imsgc_hg38_pos.txt'
+    # persistent index of hg38 positions, built from the dbSNP dump the first time
+    db_snp_hg38_index = db_snp_hg38 + '.index'
+
+    # read binary filesets (.bed/.bim/.fam) when available, text ped/map otherwise
+    use_bed = has_bed_files(ped_files_path)
 
     db_imsgc_snps = SnpDatabase()
-    db_imsgc_snps.load_from_map_files(ped_files_path, PED_FILE_NAME_REGEX)
+    db_imsgc_snps.load_from_map_files(ped_files_path, PED_FILE_NAME_REGEX, ext='bim' if use_bed else 'map')
     db_imsgc_snps.load_missing_info(os.path.join(imsgc_dbgap_base, 'missing_output'))
     db_imsgc_snps.print_stats()
 
-    if os.path.isfile(imsgc_gwas_positions):
-        db_imsgc_snps.read_position(imsgc_gwas_positions, HG38_POS)
-    else:
-        db_imsgc_snps.add_ucsc_db_snp_position(db_snp_hg38, HG38_POS)
-        db_imsgc_snps.write_position(imsgc_gwas_positions, HG38_POS)
+    db_imsgc_snps.add_ucsc_db_snp_position(db_snp_hg38, HG38_POS, index_dir=db_snp_hg38_index)
 
-    gwas_snps = load_gwas_snps(ped_files_path)
-    load_missing_info_from_ped(ped_files_path, gwas_snps, tfam)
+    if use_bed:
+        gwas_snps = load_gwas_snps_from_bed(ped_files_path, tfam)
+    else:
+        gwas_snps = load_gwas_snps(ped_files_path)
+        load_missing_info_from_ped(ped_files_path, gwas_snps, tfam)
     check_missing_with_plink_results(db_imsgc_snps, gwas_snps)
 
-    tracks = generate_missing_tracks(db_imsgc_snps, HG38_POS)
+    # QC tracks built along with the missing tracks
+    qc_tracks = [('fmiss_mean', 'lmiss.F_MISS', 'mean', None), ('fmiss_max', 'lmiss.F_MISS', 'max', None)]
+    tracks = generate_missing_tracks(db_imsgc_snps, HG38_POS, qc_tracks=qc_tracks)
     out_dir_tracks = '/home/victor/Escritorio/Genotipado_Alternativo/data/out_hg38_tracks'
 
-    for wsize in WINDOW_SIZES:
-        hf_wsize = human_format(wsize)
-        base_file_path = os.path.join(out_dir_tracks, hf_wsize)
-        write_wig(tracks[hf_wsize], base_file_path, wsize)
+    write_tracks(tracks, out_dir_tracks, file_formats=['wig', 'bw'], jobs=multiprocessing.cpu_count())
 
     print 'Finished:', datetime.datetime.now().isoformat()
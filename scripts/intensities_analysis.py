@@ -100,18 +100,19 @@ if __name__ == "__main__":
     tfam = Tfam(os.path.join(birdseed_base, 'matesanz2015.tfam'))
     db = SnpDatabase()
     db.load_from_birdseed(birdseed_base, '8090939')
-    intensities = Intensities.load_birdseed_summary_intensities(
-        os.path.join(birdseed2_base, 'birdseed-dev.summary.txt.gz'), limit=-1)
+    # memory mapped intensities, rows are read on demand
+    intensities = Intensities.open_birdseed_summary_matrix(
+        os.path.join(birdseed2_base, 'birdseed-dev.summary.txt.gz'))
 
-    parents_index = np.array(tfam.get_parents_index(intensities['subjects']))
-    offspring_index = np.array(tfam.get_offspring_index(intensities['subjects']))
+    parents_index = np.array(tfam.get_parents_index(intensities.subjects))
+    offspring_index = np.array(tfam.get_offspring_index(intensities.subjects))
 
     samples_sets = {'PosDiff': MISSING_POSITIVE, 'NegDiff': MISSING_NEGATIVE}
 
     for label in {'PosDiff': MISSING_POSITIVE, 'NegDiff': MISSING_NEGATIVE}:
         for probe_id in samples_sets[label]:
             to_file = os.path.join(out_dir, probe_id + label + '.png')
-            plot_a_b_intensities(probe_id, db.get_rs_id(None, probe_id), intensities['intensities'], parents_index,
+            plot_a_b_intensities(probe_id, db.get_rs_id(None, probe_id), intensities, parents_index,
                                  offspring_index, to_file=to_file)
 
     print 'Finished:', datetime.datetime.now().isoformat()
@@ -0,0 +1,75 @@
+import json
+import time
+import threading
+import SocketServer
+import BaseHTTPServer
+
+
+class StubHttpServer(object):
+    def __init__(self, responder, delay=0):
+        """
+        Local HTTP server (ephemeral port, one thread per connection) for transport tests. Every request is
+        answered by responder and the server keeps count of the requests and of the max number of requests in
+        flight at the same time.
+        :param responder: function (method, path, body, num_request) returning (status, headers dict, json data)
+        :param delay: seconds each request is held before answering
+        """
+        self.responder = responder
+        self.delay = delay
+        self.num_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = _ThreadingHttpServer(('127.0.0.1', 0), self.__make_handler())
+        self.url = 'http://127.0.0.1:%i' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive connections
+
+            def __handle(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub.lock:
+                    stub.num_requests += 1
+                    num_request = stub.num_requests
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    time.sleep(stub.delay)
+                    status, headers, data = stub.responder(self.command, self.path, body, num_request)
+                finally:
+                    with stub.lock:
+                        stub.in_flight -= 1
+
+                content = json.dumps(data) if data is not None else ''
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self.__handle()
+
+            def do_POST(self):
+                self.__handle()
+
+            def log_message(self, format, *args):
+                pass  # quiet
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _ThreadingHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
@@ -0,0 +1,92 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from classes.ensembl_cache import EnsemblCache
+from classes.ensembl_client import EnsemblRestClient
+from classes.ensembl_batch import VariationBatchJob
+from tests.stub_http_server import StubHttpServer
+
+
+class VariationBatchJobTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.tmp_dir, 'variations.checkpoint')
+        self.requested_ids = []  # ids of every POST
+        self.server = StubHttpServer(self.__respond)
+        self.client = EnsemblRestClient(server=self.server.url)
+
+    def tearDown(self):
+        self.client.transport.close()
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def __respond(self, method, path, body, num_request):
+        # every id is found except 'rs404'
+        ids = json.loads(body)['ids']
+        self.requested_ids += ids
+        return 200, {}, {rs_id: {'name': rs_id} for rs_id in ids if rs_id != 'rs404'}
+
+    def __write_checkpoint(self, lines):
+        f = open(self.checkpoint_file, 'w')
+        for line in lines:
+            f.write(json.dumps(line) + '\n')
+        f.close()
+
+    @staticmethod
+    def __requested_hash(ids):
+        job = VariationBatchJob(None)
+        job.requested = ids
+        return job._VariationBatchJob__requested_hash()
+
+    def test_run(self):
+        job = VariationBatchJob(self.client, checkpoint_file=self.checkpoint_file)
+        snps = job.run(['rs1', 'rs2', 'rs404', 'rs1'])
+        self.assertEqual(sorted(snps), ['rs1', 'rs2'])
+        self.assertEqual(job.missing, set(['rs404']))
+        self.assertFalse(os.path.exists(self.checkpoint_file))  # removed when the job finishes
+
+    def test_resume(self):
+        ids = ['rs1', 'rs2', 'rs3']
+        self.__write_checkpoint([{'requested': self.__requested_hash(ids)},
+                                 {'found': {'rs1': {'name': 'rs1'}}, 'missing': ['rs2']}])
+        job = VariationBatchJob(self.client, checkpoint_file=self.checkpoint_file)
+        snps = job.run(ids)
+        self.assertEqual(self.requested_ids, ['rs3'])
+        self.assertEqual(sorted(snps), ['rs1', 'rs3'])
+        self.assertEqual(job.missing, set(['rs2']))
+
+    def test_checkpoint_of_other_ids(self):
+        self.__write_checkpoint([{'requested': self.__requested_hash(['rs7', 'rs8'])},
+                                 {'found': {'rs7': {'name': 'rs7'}, 'rs1': {'name': 'old'}}, 'missing': ['rs8']}])
+        job = VariationBatchJob(self.client, checkpoint_file=self.checkpoint_file)
+        snps = job.run(['rs1', 'rs2'])
+        self.assertEqual(sorted(self.requested_ids), ['rs1', 'rs2'])
+        self.assertEqual(snps, {'rs1': {'name': 'rs1'}, 'rs2': {'name': 'rs2'}})
+        self.assertEqual(job.missing, set([]))
+
+    def test_checkpoint_without_header(self):
+        self.__write_checkpoint([{'found': {'rs9': {'name': 'rs9'}}, 'missing': []}])
+        job = VariationBatchJob(self.client, checkpoint_file=self.checkpoint_file)
+        self.assertEqual(sorted(job.run(['rs1'])), ['rs1'])
+
+    def test_offline_expired(self):
+        # ttl=0: every cached entry is expired, offline runs still serve them and do not evict them
+        cache = EnsemblCache(os.path.join(self.tmp_dir, 'cache.db'), ttl=0)
+        cache.put_variations('human', 'GRCh38', ['rs1', 'rs404'], {'rs1': {'name': 'rs1'}})
+        client = EnsemblRestClient(server=self.server.url, cache=cache, offline=True)
+        try:
+            for _ in range(2):
+                job = VariationBatchJob(client)
+                self.assertEqual(job.run(['rs1', 'rs404']), {'rs1': {'name': 'rs1'}})
+                self.assertEqual(job.missing, set(['rs404']))
+                self.assertEqual(job.failed, set([]))
+            self.assertEqual(self.requested_ids, [])
+        finally:
+            client.transport.close()
+            cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from classes.gene_database import GeneDatabase
+
+MART_ROWS = [
+    'G1\t1\t100\t200\t1\tAAA\tprotein_coding',
+    'G2\t1\t50\t60\t-1\tBBB\tprotein_coding',
+    'G3\tMT\t1\t2\t1\tCCC\tprotein_coding',  # not a valid chr
+    'G1\t2\t300\t400\t-1\tDDD\tlincRNA',  # repeated id, the last row wins
+]
+
+
+class GeneDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mart_file = os.path.join(self.tmp_dir, 'mart_export.txt.gz')
+        f = gzip.open(self.mart_file, 'w')
+        f.write('Gene stable ID\tChromosome/scaffold name\tGene start (bp)\tGene end (bp)\tStrand\tGene name\t'
+                'Gene type\n')
+        for row in MART_ROWS:
+            f.write(row + '\n')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def __check_db(self, db):
+        self.assertEqual(db.get_num_genes(), 2)
+        self.assertEqual(tuple(db.get_by_id('G1')), ('G1', 'DDD', '2', 300, 400, -1, 'lincRNA'))
+        self.assertEqual(db.get_by_name('ddd').id, 'G1')
+        self.assertEqual(db.get_by_name('bbb').id, 'G2')
+        self.assertIsNone(db.get_by_id('G3'))
+        self.assertEqual(list(db.get_genes_in_range('1', 0, 1000)), [db.get_index('G2')])
+
+    def test_load_mart_export(self):
+        db = GeneDatabase('9606')
+        db.load_mart_export(self.mart_file)
+        self.__check_db(db)
+        self.assertEqual(os.listdir(self.tmp_dir), ['mart_export.txt.gz'])  # no snapshot by default
+        self.assertIsNone(db.source_hash)  # the mart file is only hashed for snapshots
+        self.assertEqual(db.source_stamp[0], self.mart_file)
+
+    def test_snapshot(self):
+        snapshot_dir = os.path.join(self.tmp_dir, 'genes.snapshot')
+        db = GeneDatabase('9606')
+        db.load_mart_export(self.mart_file, snapshot_dir=snapshot_dir)
+        self.assertTrue(os.path.isfile(os.path.join(snapshot_dir, 'meta.json')))
+
+        db = GeneDatabase('9606')
+        self.assertTrue(db.load_snapshot(snapshot_dir, db._GeneDatabase__file_hash(self.mart_file)))
+        self.__check_db(db)
+
+        db = GeneDatabase('9606')
+        db.load_mart_export(self.mart_file, snapshot_dir=snapshot_dir)
+        self.__check_db(db)
+
+    def test_snapshot_not_writable(self):
+        # parent directory does not exist: the snapshot is not saved and the mart file is parsed
+        db = GeneDatabase('9606')
+        db.load_mart_export(self.mart_file, snapshot_dir=os.path.join(self.tmp_dir, 'missing', 'genes.snapshot'))
+        self.__check_db(db)
+
+    def test_snapshot_corrupt(self):
+        snapshot_dir = os.path.join(self.tmp_dir, 'genes.snapshot')
+        GeneDatabase('9606').load_mart_export(self.mart_file, snapshot_dir=snapshot_dir)
+        os.remove(os.path.join(snapshot_dir, 'names.npy'))
+
+        db = GeneDatabase('9606')
+        db.load_mart_export(self.mart_file, snapshot_dir=snapshot_dir)
+        self.__check_db(db)
+
+
+if __name__ == '__main__':
+    unittest.main()
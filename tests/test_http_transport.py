@@ -0,0 +1,90 @@
+import json
+import time
+import email.utils
+import unittest
+from classes.http_transport import HttpTransport
+from tests.stub_http_server import StubHttpServer
+
+
+class HttpTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+        self.transport = None
+
+    def tearDown(self):
+        if self.transport is not None:
+            self.transport.close()
+        if self.server is not None:
+            self.server.close()
+
+    def __start(self, responder, delay=0, **kwargs):
+        self.server = StubHttpServer(responder, delay=delay)
+        self.transport = HttpTransport(**kwargs)
+
+    @staticmethod
+    def __rate_limited(retry_after, num_limited=1):
+        # responder answering 429 to the first requests
+        def responder(method, path, body, num_request):
+            if num_request <= num_limited:
+                headers = {'Retry-After': retry_after} if retry_after is not None else {}
+                return 429, headers, None
+            return 200, {}, {'path': path}
+        return responder
+
+    def test_request(self):
+        self.__start(lambda method, path, body, num_request: (200, {}, {'method': method, 'body': body}))
+        res = self.transport.request('POST', self.server.url + '/variation/human', data=json.dumps({'ids': ['rs1']}))
+        self.assertEqual(res, {'method': 'POST', 'body': '{"ids": ["rs1"]}'})
+
+    def test_error_status(self):
+        self.__start(lambda method, path, body, num_request: (500, {}, None))
+        self.assertIsNone(self.transport.request('GET', self.server.url + '/info/ping'))
+
+    def test_retry_after_seconds(self):
+        self.__start(self.__rate_limited('1'))
+        start = time.time()
+        res = self.transport.request('GET', self.server.url + '/info/ping')
+        self.assertEqual(res, {'path': '/info/ping'})
+        self.assertEqual(self.server.num_requests, 2)
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_retry_after_http_date(self):
+        retry_after = email.utils.formatdate(time.time() + 1, usegmt=True)
+        self.__start(self.__rate_limited(retry_after))
+        res = self.transport.request('GET', self.server.url + '/info/ping')
+        self.assertEqual(res, {'path': '/info/ping'})
+        self.assertEqual(self.server.num_requests, 2)
+
+    def test_retry_after_invalid(self):
+        # falls back to waiting 1 second
+        self.__start(self.__rate_limited('soon'))
+        start = time.time()
+        self.assertEqual(self.transport.request('GET', self.server.url + '/info/ping'), {'path': '/info/ping'})
+        self.assertGreaterEqual(time.time() - start, 0.9)
+
+    def test_max_retries(self):
+        self.__start(self.__rate_limited('0', num_limited=10), max_retries=2)
+        self.assertIsNone(self.transport.request('GET', self.server.url + '/info/ping'))
+        self.assertEqual(self.server.num_requests, 3)
+
+    def test_map_concurrency(self):
+        self.__start(lambda method, path, body, num_request: (200, {}, {'path': path}), delay=0.2,
+                     reqs_per_sec=100, max_workers=4)
+        items = ['/item/%i' % i for i in range(12)]
+        start = time.time()
+        res = self.transport.map(lambda path: self.transport.request('GET', self.server.url + path), items)
+        elapsed = time.time() - start
+        self.assertEqual(res, [{'path': path} for path in items])
+        self.assertEqual(self.server.max_in_flight, 4)
+        self.assertLess(elapsed, 12 * 0.2 / 2)
+
+    def test_map_rate_limited(self):
+        # a 429 in the middle of a concurrent batch does not fail the batch
+        self.__start(self.__rate_limited('Wed, 21 Oct 2015 07:28:00 GMT', num_limited=2), max_workers=4)
+        items = ['/item/%i' % i for i in range(6)]
+        res = self.transport.map(lambda path: self.transport.request('GET', self.server.url + path), items)
+        self.assertEqual(res, [{'path': path} for path in items])
+
+
+if __name__ == '__main__':
+    unittest.main()
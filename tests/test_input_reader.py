@@ -0,0 +1,48 @@
+import os
+import gzip
+import time
+import shutil
+import tempfile
+import unittest
+from classes.input_reader import InputReader
+
+
+class InputReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lines = ['line %i\t%s\n' % (i, 'x' * (i % 50)) for i in range(20000)] + ['last line without eol']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def __write(self, file_name, compress):
+        file_path = os.path.join(self.tmp_dir, file_name)
+        f = gzip.open(file_path, 'wb') if compress else open(file_path, 'wb')
+        f.write(''.join(self.lines))
+        f.close()
+        return file_path
+
+    def test_read_lines(self):
+        for file_name, compress in (('plain.txt', False), ('data.txt.gz', True)):
+            with InputReader(self.__write(file_name, compress), block_size=1 << 12) as f:
+                self.assertEqual(f.readline(), self.lines[0])
+                self.assertEqual(list(f), self.lines[1:])
+                self.assertEqual(f.readline(), '')
+
+    def test_queued_bytes(self):
+        # the producer stops queueing blocks when max_queued_bytes is reached
+        with InputReader(self.__write('plain.txt', False), block_size=1 << 12, max_queued_bytes=1 << 14) as f:
+            time.sleep(0.2)
+            self.assertLessEqual(f.queued_bytes, 1 << 14)
+            self.assertGreater(f.queued_bytes, 0)
+            self.assertEqual(sum(len(block) for block in f.iter_blocks()), len(self.lines))
+
+    def test_close_unread(self):
+        f = InputReader(self.__write('plain.txt', False), block_size=1 << 12, max_queued_bytes=1 << 12)
+        f.readline()
+        f.close()
+        self.assertFalse(f.worker.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+from classes.parallel import run_jobs
+
+
+def _scale(shared, item):
+    if item < 0:
+        raise ValueError('negative item')
+    return item * shared['factor']
+
+
+class RunJobsTest(unittest.TestCase):
+    def test_run_jobs(self):
+        items = range(20)
+        self.assertEqual(list(run_jobs(_scale, items, shared={'factor': 3})), [i * 3 for i in items])
+        self.assertEqual(sorted(run_jobs(_scale, items, jobs=3, shared={'factor': 3}, chunksize=4)),
+                         [i * 3 for i in items])
+
+    def test_failed_job(self):
+        for jobs in (1, 2):
+            with self.assertRaises(ValueError):
+                list(run_jobs(_scale, [1, 2, -1, 3], jobs=jobs, shared={'factor': 1}))
+            # the state of the failed run is released
+            self.assertEqual(list(run_jobs(_scale, [1], jobs=jobs, shared={'factor': 2})), [2])
+
+    def test_closed_early(self):
+        results = run_jobs(_scale, range(10), jobs=2, shared={'factor': 1})
+        results.next()
+        results.close()
+        self.assertEqual(list(run_jobs(_scale, [4], shared={'factor': 2})), [8])
+
+
+if __name__ == '__main__':
+    unittest.main()